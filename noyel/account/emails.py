@@ -1,10 +1,10 @@
 from django.utils.translation import ugettext as _, get_language
 from django.conf import settings
 
-from toolbox.emails import EmailTemplate
+from noyel.kdo.emails import CachedEmailTemplate
 
 
-class EmailVerificationEmail(EmailTemplate):
+class EmailVerificationEmail(CachedEmailTemplate):
     # TODO: docstring
     @property # XXX: A property is needed because lazy objects dont work here
     def subject_template(self):
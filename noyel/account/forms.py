@@ -1,4 +1,4 @@
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage
 from django import forms
 from django.template import loader
 from django.utils.encoding import force_bytes
@@ -13,6 +13,7 @@ from django.contrib.auth.tokens import default_token_generator
 from django.contrib.sites.models import get_current_site
 
 from noyel.account.models import EmailAddress
+from noyel.kdo.models import OutboundEmail
 
 
 class CleanUsernameMixin(object):
@@ -108,5 +109,6 @@ class CustomPasswordResetForm(PasswordResetForm):
             # Email subject *must not* contain newlines
             subject = ''.join(subject.splitlines())
             body = loader.render_to_string(email_template_name, c)
-            send_mail(subject, body, from_email, [email.email])
+            OutboundEmail.objects.queue(EmailMessage(subject, body, from_email,
+                                                     [email.email]))
 
@@ -6,10 +6,11 @@ def get_friends_for_user(user, queryset=None):
     
     If a queryset is passed, use that as a base.
     
+    The friendships are read from the denormalized kdo.Friendship table which
+    is kept up to date when participants are added or removed.
+    
     """
     # TODO: this should really be a method on the User class.
     if queryset is None:
         queryset = User.objects.all()
-    return queryset.exclude(pk=user.pk)\
-                   .filter(participant__present__participants__user=user)\
-                   .distinct()
+    return queryset.filter(friend_of__user=user)
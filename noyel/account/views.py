@@ -11,6 +11,7 @@ from django.db import transaction
 from toolbox.next import NextMixin
 from toolbox.messages import MessageMixin, FormMessageMixin, DeleteMessageMixin
 from noyel.kdo.mixins import LoginRequiredMixin, UserQuerysetMixin
+from noyel.kdo.models import OutboundEmail
 from noyel.account.models import EmailAddress
 from noyel.account.forms import (SignupForm, ProfileUpdateForm,
                                  PasswordChangeForm, EmailAddressForm,
@@ -119,6 +120,7 @@ class EmailCreateView(LoginRequiredMixin, NextMixin, FormMessageMixin, generic.C
         kwargs['user'] = self.request.user
         return kwargs
     
+    @transaction.atomic
     def form_valid(self, form):
         # create self.object
         response = super(EmailCreateView, self).form_valid(form)
@@ -126,11 +128,12 @@ class EmailCreateView(LoginRequiredMixin, NextMixin, FormMessageMixin, generic.C
         return response
     
     def send_email(self, email_address):
+        """Queue the verification email in the outbox."""
         template = EmailVerificationEmail()
         message = template.render({'user': self.request.user,
                                    'email': email_address,
                                    'site': get_current_site(self.request)})
-        return message.send()
+        return OutboundEmail.objects.queue(message)
 
 email_create = EmailCreateView.as_view()
 
@@ -167,11 +170,12 @@ class EmailResendVerifyMessageView(LoginRequiredMixin, UserQuerysetMixin, NextMi
         return self.redirect()
     
     def send_email(self, email_address):
+        """Queue the verification email in the outbox."""
         template = EmailVerificationEmail()
         message = template.render({'user': self.request.user,
                                    'email': email_address,
                                    'site': get_current_site(self.request)})
-        return message.send()
+        return OutboundEmail.objects.queue(message)
 
 email_resend_verify_message = EmailResendVerifyMessageView.as_view()
 
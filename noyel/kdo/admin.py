@@ -1,8 +1,14 @@
 from django.contrib import admin
 
-from noyel.kdo.models import Invitation
+from noyel.kdo.models import Invitation, OutboundEmail
 
 
 class InvitationAdmin(admin.ModelAdmin):
     pass
 admin.site.register(Invitation, InvitationAdmin)
+
+
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ['subject', 'to', 'created_on', 'sent_on', 'attempts']
+    list_filter = ['sent_on']
+admin.site.register(OutboundEmail, OutboundEmailAdmin)
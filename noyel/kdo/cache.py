@@ -0,0 +1,139 @@
+"""Cache keys and invalidation helpers for per-user data that is expensive to
+compute on every request, and the conditional GET helpers built on them.
+
+The cached values are invalidated by the receivers in `noyel.kdo.signals`.
+
+"""
+import hashlib
+import threading
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils.crypto import get_random_string
+from django.utils.translation import get_language
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+
+INVITATION_COUNT_KEY = 'kdo:invitation-count:%s'
+INVITATION_COUNT_TIMEOUT = 60 * 60 * 24
+
+DATA_VERSION_KEY = 'kdo:data-version:%s'
+DATA_VERSION_TIMEOUT = 60 * 60 * 24 * 7
+
+PRESENT_IDS_KEY = 'kdo:present-ids:%s'
+PRESENT_IDS_TIMEOUT = 60 * 60 * 24
+
+# The keys to delete again once the current transaction is committed.
+_pending = threading.local()
+
+
+def check_cache_backend():
+    """Raise ImproperlyConfigured if the default cache is local to each
+    process while DEBUG is False.
+    
+    The cached values are invalidated by the process that changes the data:
+    with a local-memory cache, the other processes would keep serving stale
+    data versions, and so stale pages behind valid ETags, and would keep
+    using stale present ids to check who can access the presents.
+    
+    """
+    if not settings.DEBUG and isinstance(cache, LocMemCache):
+        raise ImproperlyConfigured("The default cache must be shared by all "
+                                   "the processes (like memcached) when "
+                                   "DEBUG is False.")
+
+
+def invitation_count_key(user_pk):
+    """Return the cache key holding the invitation count of the given user."""
+    return INVITATION_COUNT_KEY % user_pk
+
+
+def invalidate_invitation_count(user_pks):
+    """Clear the cached invitation count of all the given users."""
+    cache.delete_many([invitation_count_key(pk) for pk in user_pks])
+
+
+def present_ids_key(user_pk):
+    """Return the cache key holding the ids of the presents the given user
+    participates in.
+    
+    """
+    return PRESENT_IDS_KEY % user_pk
+
+
+def invalidate_present_ids(user_pks):
+    """Clear the cached present ids of all the given users."""
+    delete_after_commit([present_ids_key(pk) for pk in user_pks])
+
+
+def delete_after_commit(keys):
+    """Delete the given cache keys now and, when a transaction is open,
+    once more after the request (see CacheInvalidationMiddleware).
+    
+    Until the transaction is committed, concurrent requests still read the
+    old data from the database and could cache it again.
+    
+    """
+    cache.delete_many(keys)
+    if connection.in_atomic_block:
+        if not hasattr(_pending, 'keys'):
+            _pending.keys = set()
+        _pending.keys.update(keys)
+
+
+def delete_pending_keys():
+    """Delete the keys given to delete_after_commit during a transaction."""
+    keys = getattr(_pending, 'keys', None)
+    if keys:
+        cache.delete_many(list(keys))
+        keys.clear()
+
+
+def data_version(user_pk):
+    """Return an opaque token that changes whenever something the given user
+    can see (presents, comments, participants, invitations, friends...)
+    changes.
+    
+    """
+    key = DATA_VERSION_KEY % user_pk
+    version = cache.get(key)
+    if version is None:
+        version = get_random_string(12)
+        cache.set(key, version, DATA_VERSION_TIMEOUT)
+    return version
+
+
+def invalidate_data_version(user_pks):
+    """Change the data version of all the given users."""
+    cache.delete_many([DATA_VERSION_KEY % pk for pk in user_pks])
+
+
+def user_data_etag(request, *args, **kwargs):
+    """Return an ETag for a page that only depends on the current user's data
+    (see data_version), for use with django.views.decorators.http.condition.
+    
+    Anonymous users and requests with pending messages (which the page would
+    display) get no ETag.
+    
+    """
+    if not request.user.is_authenticated() or len(get_messages(request)):
+        return None
+    parts = [data_version(request.user.pk), request.user.pk, get_language(),
+             request.META.get('CSRF_COOKIE', '')]
+    return hashlib.md5(':'.join(map(str, parts))).hexdigest()
+
+
+def user_data_condition(view):
+    """Decorate a view whose output only depends on the current user's data
+    so that it answers conditional GET requests (see user_data_etag).
+    
+    The response is marked private and must be revalidated: browsers keep it
+    and ask again with If-None-Match, which is cheap.
+    
+    """
+    view = condition(etag_func=user_data_etag)(view)
+    return cache_control(private=True, no_cache=True)(view)
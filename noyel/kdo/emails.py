@@ -1,10 +1,70 @@
+from django.utils import translation
 from django.utils.translation import ugettext as _, get_language
 from django.conf import settings
+from django.template import Context, Template
+from django.template.loader import get_template
 
 from toolbox.emails import EmailTemplate
 
 
-class InvitationEmail(EmailTemplate):
+class CachedEmailTemplate(EmailTemplate):
+    """An EmailTemplate that compiles its subject, recipient and body
+    templates only once per language instead of every time a message is
+    rendered.
+    
+    The templates are rendered through render_subject, render_to and
+    render_body, the extension points documented by EmailTemplate, so the
+    cache doesn't depend on its internals.
+    
+    """
+    _templates = {}
+    
+    def get_template(self, attr):
+        """Return the compiled `<attr>_template_name` or `<attr>_template` of
+        the active language, compiling it the first time.
+        
+        """
+        key = (self.__class__, attr, get_language())
+        try:
+            return self._templates[key]
+        except KeyError:
+            name = getattr(self, '%s_template_name' % attr, None)
+            if name is not None:
+                template = get_template(name)
+            else:
+                template = Template(getattr(self, '%s_template' % attr))
+            self._templates[key] = template
+            return template
+    
+    def render_subject(self, context):
+        value = self.get_template('subject').render(Context(context))
+        return u' '.join(line.strip() for line in value.split('\n'))
+    
+    def render_to(self, context):
+        value = self.get_template('to').render(Context(context))
+        return [line.strip() for line in value.split('\n')]
+    
+    def render_body(self, context):
+        return self.get_template('body').render(Context(context))
+    
+    @classmethod
+    def warm_cache(cls):
+        """Compile the templates of all subclasses for every language in
+        settings.LANGUAGES.
+        
+        """
+        subclasses = cls.__subclasses__()
+        while subclasses:
+            subclass = subclasses.pop()
+            subclasses.extend(subclass.__subclasses__())
+            template = subclass()
+            for language, name in settings.LANGUAGES:
+                with translation.override(language):
+                    for attr in ('subject', 'to', 'body'):
+                        template.get_template(attr)
+
+
+class InvitationEmail(CachedEmailTemplate):
     """An email containing a link to redeem an invitation, allowing a user
     to be added to the participants of a present.
     
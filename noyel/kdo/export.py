@@ -0,0 +1,144 @@
+"""Export of a user's presents (with their participants, comments,
+invitations and purchase information) as CSV or newline-delimited JSON.
+
+The presents are fetched in chunks of `CHUNK_SIZE` (with their related
+objects prefetched one chunk at a time) and the output is generated line
+by line, so the memory used doesn't depend on the number of presents.
+
+"""
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+
+from noyel.kdo.models import Present
+from noyel.kdo.utils import normalize_giftee
+
+CHUNK_SIZE = 200
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+CSV_COLUMNS = ['id', 'title', 'giftee', 'status', 'description', 'link',
+               'price', 'created_on', 'updated_on', 'bought_by',
+               'participants', 'comments', 'invitations']
+
+
+def _start_of_day(date):
+    return timezone.make_aware(datetime.combine(date, time.min),
+                               timezone.get_current_timezone())
+
+
+def get_presents(user, giftee=None, status=None, since=None, until=None):
+    """Return the queryset of the presents of the given user to export,
+    filtered by giftee, status and creation date (both bounds included).
+    
+    """
+    qs = Present.objects.filter(participants__user=user)
+    if giftee:
+        qs = qs.filter(giftee_key=normalize_giftee(giftee))
+    if status is not None:
+        qs = qs.filter(status=status)
+    if since:
+        qs = qs.filter(created_on__gte=_start_of_day(since))
+    if until:
+        qs = qs.filter(created_on__lt=_start_of_day(until + timedelta(days=1)))
+    return qs
+
+
+def iter_presents(queryset, chunk_size=CHUNK_SIZE):
+    """Iterate over the presents of the queryset, `chunk_size` at a time, with
+    their related objects prefetched.
+    
+    """
+    queryset = queryset.select_related('bought_by').prefetch_related(
+        'participants__user', 'comment_set__author',
+        'invitation_set__sent_by').order_by('pk')
+    last_pk = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+        for present in chunk:
+            yield present
+        if len(chunk) < chunk_size:
+            break
+        last_pk = chunk[-1].pk
+
+
+def serialize(present):
+    """Return a dictionary of the present's data, ready to dump as json."""
+    return {
+        'id': present.pk,
+        'title': present.title,
+        'giftee': present.giftee,
+        'status': present.get_status_display(),
+        'description': present.description,
+        'link': present.link,
+        'price': unicode(present.price) if present.price is not None else None,
+        'created_on': present.created_on.isoformat(),
+        'updated_on': present.updated_on.isoformat(),
+        'bought_by': present.bought_by.username if present.bought_by else None,
+        'participants': [p.user.username for p in present.participants.all()],
+        'comments': [{
+            'author': comment.author.username,
+            'posted_on': comment.posted_on.isoformat(),
+            'text': comment.text,
+        } for comment in present.comment_set.all()],
+        'invitations': [{
+            'sent_to': invitation.sent_to,
+            'sent_by': invitation.sent_by.username,
+            'sent_on': invitation.sent_on.isoformat(),
+        } for invitation in present.invitation_set.all()],
+    }
+
+
+class _Echo(object):
+    """A file-like object whose write method returns what it is given, so that
+    csv.writer can produce lines one at a time.
+    
+    """
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    return unicode(value).encode('utf-8')
+
+
+def export_csv(presents):
+    """Yield the lines of a CSV file of the given presents. The related
+    objects are flattened into one column each, one per line.
+    
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for present in presents:
+        data = serialize(present)
+        data['participants'] = u', '.join(data['participants'])
+        data['comments'] = u'\n'.join(
+            u'[%(posted_on)s] %(author)s: %(text)s' % c
+            for c in data['comments'])
+        data['invitations'] = u'\n'.join(
+            u'%(sent_to)s (%(sent_by)s, %(sent_on)s)' % i
+            for i in data['invitations'])
+        yield writer.writerow([_csv_value(data[c]) for c in CSV_COLUMNS])
+
+
+def export_ndjson(presents):
+    """Yield one line of json for each of the given presents."""
+    for present in presents:
+        yield json.dumps(serialize(present)) + '\n'
+
+
+def export(presents, format):
+    """Yield the lines of the export of the given presents in the given
+    format (one of FORMATS).
+    
+    """
+    if format == 'ndjson':
+        return export_ndjson(presents)
+    return export_csv(presents)
@@ -1,10 +1,16 @@
+import re
+
 from django import forms
 from django.contrib.auth.models import User
+from django.db import transaction, IntegrityError
 from django.utils.translation import ugettext_lazy as _
 from django.core.validators import validate_email
+from django.forms.forms import NON_FIELD_ERRORS
 
-from noyel.kdo.models import Present, Comment, Invitation
-from noyel.account.utils import get_friends_for_user
+from noyel.account.models import EmailAddress
+from noyel.kdo import signals, transitions
+from noyel.kdo.export import FORMATS
+from noyel.kdo.models import Present, Comment, Invitation, Participant
 
 
 class UserFormMixin(object):
@@ -18,7 +24,7 @@ class BasePresentForm(forms.ModelForm):
     class Meta:
         model = Present
         fields = ['title', 'giftee', 'description', 'link', 'price']
-
+    
     def __init__(self, *args, **kwargs):
         super(BasePresentForm, self).__init__(*args, **kwargs)
         self.fields['price'].localize = True
@@ -31,8 +37,51 @@ class PresentCreateForm(UserFormMixin, BasePresentForm):
         return present
 
 
-class PresentUpdateForm(BasePresentForm):
-    pass
+class EditConflict(Exception):
+    """Raised by the save method of a VersionedFormMixin form when the present
+    changed since the form was displayed.
+    
+    """
+
+
+class VersionedFormMixin(object):
+    """A present modelform that only saves the present if nobody changed it
+    since the form was displayed (see Present.save_if_unchanged).
+    
+    The present's version is kept in a hidden field. On a conflict, save()
+    raises EditConflict and conflict() adds the error to the form and moves
+    it to the present's current version, so that submitting it again
+    overwrites the other change.
+    
+    """
+    conflict_message = _("This present has been changed by someone else "
+                         "since you opened this page. Check the present then "
+                         "submit the form again.")
+    
+    def __init__(self, *args, **kwargs):
+        super(VersionedFormMixin, self).__init__(*args, **kwargs)
+        self.fields['version'] = forms.IntegerField(
+            widget=forms.HiddenInput, initial=self.instance.version)
+    
+    def save_if_unchanged(self, instance, fields, **conditions):
+        if not instance.save_if_unchanged(self.cleaned_data['version'], fields,
+                                          **conditions):
+            raise EditConflict(self.conflict_message)
+    
+    def conflict(self, error):
+        self.data = self.data.copy()
+        self.data[self.add_prefix('version')] = Present.objects.filter(
+            pk=self.instance.pk).values_list('version', flat=True)[0]
+        self.errors[NON_FIELD_ERRORS] = self.error_class(
+            [unicode(error)])
+
+
+class PresentUpdateForm(VersionedFormMixin, BasePresentForm):
+    def save(self, commit=True):
+        instance = super(PresentUpdateForm, self).save(commit=False)
+        if commit:
+            self.save_if_unchanged(instance, self._meta.fields)
+        return instance
 
 
 class BaseCommentForm(forms.ModelForm):
@@ -78,48 +127,158 @@ class FriendsChoiceField(forms.ModelMultipleChoiceField):
         return instance.username
 
 
+class MultipleEmailField(forms.CharField):
+    """A field for a list of email addresses separated by commas, semicolons or
+    whitespace. The cleaned value is a list without duplicates.
+    
+    """
+    widget = forms.Textarea(attrs={'rows': 3, 'class': 'input-xlarge'})
+    default_error_messages = {
+        'invalid': _("\"%(email)s\" is not a valid email address."),
+    }
+    
+    def to_python(self, value):
+        value = super(MultipleEmailField, self).to_python(value)
+        emails = []
+        for email in re.split(r'[\s,;]+', value):
+            if email and email not in emails:
+                emails.append(email)
+        return emails
+    
+    def validate(self, value):
+        super(MultipleEmailField, self).validate(value)
+        for email in value:
+            try:
+                validate_email(email)
+            except forms.ValidationError:
+                msg = self.error_messages['invalid'] % {'email': email}
+                raise forms.ValidationError(msg)
+
+
 class PresentInvitationForm(forms.Form):
     friends = FriendsChoiceField(required=False)
-    email = forms.EmailField(label=_("Email"), required=False)
+    emails = MultipleEmailField(label=_("Emails"), required=False,
+                                help_text=_("Separate the addresses with "
+                                            "commas or new lines."))
     
     def __init__(self, *args, **kwargs):
         self.user = kwargs.pop('user')
         self.present = kwargs.pop('present')
         super(PresentInvitationForm, self).__init__(*args, **kwargs)
-        friends = get_friends_for_user(self.user)\
-                      .exclude(participant__present=self.present)
+        friends = self.present.get_new_friends_for_user(self.user)
         self.fields['friends'].queryset = friends
     
     def clean(self):
+        """Move the addresses that belong to friends to the list of friends:
+        they are added right away instead of being sent an invitation.
+        
+        """
         cleaned = self.cleaned_data
+        if 'friends' not in cleaned or 'emails' not in cleaned:
+            return cleaned
         
-        if not cleaned['friends'] and not cleaned['email']:
-            msg = _("Please select a friend in the list or provide an email "
-                    "address.")
+        friends, emails = list(cleaned['friends']), list(cleaned['emails'])
+        if not friends and not emails:
+            msg = _("Please select some friends in the list or provide some "
+                    "email addresses.")
             raise forms.ValidationError(msg)
         
-        if cleaned['friends']:
-            return {'friends': cleaned['friends'], 'email': u''}
+        addresses = EmailAddress.objects.filter(
+            email__in=emails,
+            verified=True,
+            user__in=self.fields['friends'].queryset,
+        ).select_related('user')
+        for address in addresses:
+            emails.remove(address.email)
+            if address.user not in friends:
+                friends.append(address.user)
         
-        assert cleaned['email']
-        try:
-            base_qs = self.fields['friends'].queryset
-            user = base_qs.get(emails__email=cleaned['email'],
-                               emails__verified=True)
-        except User.DoesNotExist:
-            pass
-        else:
-            return {'friends': [user], 'email': u''}
+        return {'friends': friends, 'emails': emails}
+    
+    def save(self):
+        """Add the friends to the present's participants and create invitations
+        for the email addresses, skipping the users that already participate
+        and the addresses that were already invited.
         
-        return {'friends': None, 'email': cleaned['email']}
+        Return a tuple (added users, created invitations, skipped addresses).
+        
+        """
+        users = self._add_participants(self.cleaned_data['friends'])
+        invitations, invited = self._invite(self.cleaned_data['emails'])
+        return users, invitations, sorted(invited)
+    
+    def _participating(self, users):
+        """Return the pks of the given users that already participate."""
+        return set(Participant.objects.filter(present=self.present,
+                                              user__in=users)\
+                                      .values_list('user', flat=True))
+    
+    def _invited(self, emails):
+        """Return the given addresses that were already invited."""
+        return set(Invitation.objects.filter(present=self.present,
+                                             sent_to__in=emails)\
+                                     .values_list('sent_to', flat=True))
     
-    def save_invitation(self):
-        email = self.cleaned_data['email']
-        assert email
-        return Invitation.objects.create(present=self.present,
-                                         sent_by=self.user,
-                                         sent_to=email,
-                                         )
+    def _add_participants(self, friends):
+        """Add the given users to the participants with a single query and
+        return the ones that were added.
+        
+        If some of them were added concurrently (by a double submit for
+        instance), the others are added one at a time.
+        
+        """
+        participating = self._participating(friends)
+        users = [user for user in friends if user.pk not in participating]
+        try:
+            with transaction.atomic():
+                Participant.objects.bulk_create([
+                    Participant(present=self.present, user=user)
+                    for user in users
+                ])
+        except IntegrityError:
+            # get_or_create sends the signals itself
+            return [user for user in users
+                    if Participant.objects.get_or_create(present=self.present,
+                                                         user=user)[1]]
+        # bulk_create doesn't send any signal
+        if users:
+            signals.participants_added(self.present, [u.pk for u in users])
+        return users
+    
+    def _invite(self, emails):
+        """Create the invitations of the given addresses with a single
+        query. Return the list of the created invitations and the set of the
+        addresses that were already invited.
+        
+        If some of them were invited concurrently, the others are invited one
+        at a time.
+        
+        """
+        invited = self._invited(emails)
+        invitations = [
+            Invitation(present=self.present, sent_by=self.user, sent_to=email)
+            for email in emails if email not in invited
+        ]
+        try:
+            with transaction.atomic():
+                Invitation.objects.bulk_create(invitations)
+        except IntegrityError:
+            # get_or_create sends the signals itself
+            created = []
+            for invitation in invitations:
+                invitation, is_new = Invitation.objects.get_or_create(
+                    present=self.present, sent_to=invitation.sent_to,
+                    defaults={'sent_by': self.user})
+                if is_new:
+                    created.append(invitation)
+                else:
+                    invited.add(invitation.sent_to)
+            return created, invited
+        # bulk_create doesn't send any signal
+        if invitations:
+            signals.invitations_changed([i.sent_to for i in invitations])
+            signals.present_changed(self.present.pk)
+        return invitations, invited
 
 
 class RedeemInvitationForm(UserFormMixin, forms.Form):
@@ -143,7 +302,11 @@ class RedeemInvitationForm(UserFormMixin, forms.Form):
         return self.cleaned_data['invitation'].redeem(self.user)
 
 
-class PresentPurchaseForm(UserFormMixin, forms.ModelForm):
+class PresentPurchaseForm(UserFormMixin, VersionedFormMixin, forms.ModelForm):
+    conflict_message = _("This present has been purchased or changed by "
+                         "someone else since you opened this page. Check the "
+                         "present before buying it.")
+    
     class Meta:
         model = Present
         fields = ['price']
@@ -151,7 +314,8 @@ class PresentPurchaseForm(UserFormMixin, forms.ModelForm):
     def clean(self):
         if self.instance.bought_by:
             msg = _("This present has already been purchased by %(user)s.")
-            raise forms.ValidationError(msg % self.instance.bought_by.username)
+            raise forms.ValidationError(
+                msg % {'user': self.instance.bought_by.username})
         return super(PresentPurchaseForm, self).clean()
     
     def save(self, commit=True):
@@ -159,5 +323,103 @@ class PresentPurchaseForm(UserFormMixin, forms.ModelForm):
         instance.bought_by = self.user
         instance.status = Present.STATUS.BOUGHT
         if commit:
-            instance.save()
+            # Two participants buying at the same time: only one of them wins
+            self.save_if_unchanged(instance, ['price', 'bought_by', 'status'],
+                                   bought_by__isnull=True)
         return instance
+
+
+class ExportForm(forms.Form):
+    """Filters and format of an export of the user's presents (see
+    noyel.kdo.export).
+    
+    """
+    format = forms.ChoiceField(label=_("Format"), required=False,
+                               choices=[(f, f.upper()) for f in sorted(FORMATS)])
+    giftee = forms.CharField(label=_("Giftee"), required=False)
+    status = forms.TypedChoiceField(label=_("Status"), required=False,
+                                    choices=[('', '---------')] +
+                                            Present.STATUS.choices,
+                                    coerce=int, empty_value=None)
+    since = forms.DateField(label=_("Since"), required=False)
+    until = forms.DateField(label=_("Until"), required=False)
+    
+    def clean(self):
+        cleaned = super(ExportForm, self).clean()
+        since, until = cleaned.get('since'), cleaned.get('until')
+        if since and until and since > until:
+            raise forms.ValidationError(_("The start date must be before the "
+                                          "end date."))
+        cleaned['format'] = cleaned.get('format') or 'csv'
+        return cleaned
+
+
+class PresentImportForm(forms.Form):
+    """A CSV or JSON file of presents to import (see noyel.kdo.importer)."""
+    file = forms.FileField(label=_("File"))
+    format = forms.ChoiceField(label=_("Format"), required=False, choices=[
+        ('', _("Guess from the file name")),
+        ('csv', 'CSV'),
+        ('json', 'JSON'),
+    ])
+    
+    def clean(self):
+        cleaned = super(PresentImportForm, self).clean()
+        if not cleaned.get('format') and cleaned.get('file'):
+            name = cleaned['file'].name.lower()
+            cleaned['format'] = 'json' if name.endswith('.json') else 'csv'
+        return cleaned
+
+
+class IntegerListField(forms.Field):
+    """A list of integers, like the primary keys of the checked boxes of a
+    list.
+    
+    """
+    widget = forms.MultipleHiddenInput
+    
+    def to_python(self, value):
+        try:
+            return [int(v) for v in value or []]
+        except (TypeError, ValueError):
+            raise forms.ValidationError(_("Enter a list of whole numbers."))
+
+
+class BulkStatusForm(UserFormMixin, forms.Form):
+    """Change the status of the selected presents of the user, or of all
+    those matching the filters (see noyel.kdo.transitions).
+    
+    """
+    status = forms.TypedChoiceField(label=_("New status"), coerce=int,
+                                    choices=[(s, label) for s, label in
+                                             Present.STATUS.choices
+                                             if s in transitions.TARGETS])
+    presents = IntegerListField(label=_("Presents"), required=False)
+    giftee = forms.CharField(label=_("Giftee"), required=False)
+    current_status = forms.TypedChoiceField(label=_("Current status"),
+                                            required=False,
+                                            choices=[('', '---------')] +
+                                                    Present.STATUS.choices,
+                                            coerce=int, empty_value=None)
+    older_than = forms.IntegerField(label=_("Unchanged for (days)"),
+                                    required=False, min_value=0)
+    
+    def clean(self):
+        cleaned = super(BulkStatusForm, self).clean()
+        if not any(cleaned.get(key) not in (None, u'', [])
+                   for key in ['presents', 'giftee', 'current_status',
+                               'older_than']):
+            raise forms.ValidationError(_("Select the presents to change."))
+        return cleaned
+    
+    def get_presents(self):
+        data = self.cleaned_data
+        return transitions.get_presents(self.user, giftee=data['giftee'],
+                                        status=data['current_status'],
+                                        older_than=data['older_than'],
+                                        pks=data['presents'] or None)
+    
+    def save(self):
+        """Return the number of presents that changed."""
+        return transitions.set_status(self.get_presents(),
+                                      self.cleaned_data['status'])
@@ -0,0 +1,110 @@
+"""Import of a list of presents (title, giftee, description, link, price)
+from CSV or JSON, in a single transaction.
+
+"""
+import csv
+import json
+
+from django.db import transaction
+from django.utils.translation import ugettext as _
+
+from noyel.kdo import signals
+from noyel.kdo.forms import BasePresentForm
+from noyel.kdo.models import Present, Participant
+from noyel.kdo.utils import normalize_giftee
+
+FIELDS = ['title', 'giftee', 'description', 'link', 'price']
+MAX_ROWS = 1000
+
+
+class InvalidImport(Exception):
+    pass
+
+
+def parse(data, format):
+    """Return the list of rows (as dictionaries) of the given CSV (with a
+    header line) or JSON (a list of objects) data.
+    
+    """
+    if format == 'json':
+        try:
+            rows = json.loads(data)
+        except ValueError:
+            raise InvalidImport(_("The file isn't valid JSON."))
+        if not isinstance(rows, list) or \
+           not all(isinstance(row, dict) for row in rows):
+            raise InvalidImport(_("The JSON file must contain a list of "
+                                  "objects."))
+    else:
+        try:
+            rows = [dict((key, value.decode('utf-8'))
+                         for key, value in row.items() if key)
+                    for row in csv.DictReader(data.splitlines())]
+        except (csv.Error, UnicodeDecodeError):
+            raise InvalidImport(_("The file isn't valid UTF-8 CSV."))
+    if len(rows) > MAX_ROWS:
+        raise InvalidImport(_("A file can't contain more than %d presents.")
+                            % MAX_ROWS)
+    return rows
+
+
+def _duplicate_key(title, giftee):
+    return normalize_giftee(title), normalize_giftee(giftee)
+
+
+def import_presents(user, rows):
+    """Create a present for each of the given rows, with the given user as
+    its only participant.
+    
+    The rows are validated like the present creation form does. Rows
+    duplicating one of the user's presents (same title and giftee, ignoring
+    case and accents) or an earlier row are skipped.
+    
+    Return a tuple of the list of created presents, the list of
+    (row number, errors) of the invalid rows and the list of the numbers of
+    the skipped rows. Row numbers start at 1.
+    
+    """
+    existing = Present.objects.filter(participants__user=user)\
+                              .values_list('title', 'giftee')
+    seen = set(_duplicate_key(title, giftee) for title, giftee in existing)
+    presents, errors, skipped = [], [], []
+    for number, row in enumerate(rows, 1):
+        data = dict((field, row.get(field) or u'') for field in FIELDS)
+        form = BasePresentForm(data=data)
+        if not form.is_valid():
+            errors.append((number, form.errors))
+            continue
+        present = form.save(commit=False)
+        key = _duplicate_key(present.title, present.giftee)
+        if key in seen:
+            skipped.append(number)
+            continue
+        seen.add(key)
+        present.participant_count = 1
+        presents.append(present)
+    
+    if presents:
+        _create(user, presents)
+    return presents, errors, skipped
+
+
+@transaction.atomic
+def _create(user, presents):
+    """Insert the given presents and their participant rows.
+    
+    The presents are saved one at a time: bulk_create doesn't set their
+    primary keys, and reading them back can't tell them apart from the
+    presents inserted concurrently by other imports. The participant rows
+    are inserted with a single query.
+    
+    """
+    for present in presents:
+        present.save()
+    
+    Participant.objects.bulk_create([
+        Participant(present_id=present.pk, user=user)
+        for present in presents
+    ], batch_size=500)
+    # bulk_create doesn't send any signal
+    signals.presents_created(user, presents)
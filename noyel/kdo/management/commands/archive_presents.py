@@ -0,0 +1,55 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from noyel.kdo import transitions
+from noyel.kdo.models import Present
+
+
+class Command(BaseCommand):
+    args = '[<username> ...]'
+    help = ("Archive the presents (of the given users, or of everyone) that "
+            "were bought and haven't changed for KDO_ARCHIVE_AFTER_DAYS days. "
+            "Meant to be run periodically, from cron for instance.")
+    option_list = BaseCommand.option_list + (
+        make_option('--giftee', help="Only archive the presents for this "
+                                     "giftee."),
+        make_option('--status', type='int', default=Present.STATUS.BOUGHT,
+                    help="Only archive the presents with this status (as a "
+                         "number). Defaults to bought."),
+        make_option('--older-than', type='int', dest='older_than',
+                    default=None,
+                    help="Only archive the presents that haven't changed for "
+                         "this number of days. Defaults to "
+                         "KDO_ARCHIVE_AFTER_DAYS."),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help="Only show the number of presents to archive."),
+    )
+    
+    def handle(self, *usernames, **options):
+        older_than = options['older_than']
+        if older_than is None:
+            older_than = settings.KDO_ARCHIVE_AFTER_DAYS
+        presents = transitions.get_presents(giftee=options['giftee'],
+                                            status=options['status'],
+                                            older_than=older_than)
+        if usernames:
+            users = User.objects.filter(username__in=usernames)
+            missing = set(usernames) - set(u.username for u in users)
+            if missing:
+                raise CommandError("No user named %s."
+                                   % ", ".join(sorted(missing)))
+            presents = presents.filter(participants__user__in=users)
+        
+        if options['dry_run']:
+            # A present is counted once whatever its number of matching
+            # participants.
+            count = presents.exclude(status=Present.STATUS.ARCHIVED)\
+                            .distinct().count()
+            self.stdout.write("%d presents would be archived." % count)
+        else:
+            count = transitions.set_status(presents, Present.STATUS.ARCHIVED)
+            self.stdout.write("Archived %d presents." % count)
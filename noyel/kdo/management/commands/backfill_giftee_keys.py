@@ -0,0 +1,18 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from noyel.kdo.models import Present
+from noyel.kdo.utils import normalize_giftee
+
+
+class Command(NoArgsCommand):
+    help = "Fill in the normalized giftee key of all existing presents."
+    
+    def handle_noargs(self, **options):
+        giftees = Present.objects.values_list('giftee', flat=True).distinct()
+        count = 0
+        with transaction.atomic():
+            for giftee in giftees.iterator():
+                count += Present.objects.filter(giftee=giftee)\
+                                        .update(giftee_key=normalize_giftee(giftee))
+        self.stdout.write("Updated %d presents." % count)
@@ -0,0 +1,25 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.db.models import F
+
+from noyel.kdo.models import Present, Comment
+from noyel.kdo.utils import render_text
+
+
+class Command(NoArgsCommand):
+    help = ("Fill in the rendered HTML of the descriptions of all existing "
+            "presents and of the text of all existing comments.")
+    
+    def handle_noargs(self, **options):
+        with transaction.atomic():
+            presents = Present.objects.values_list('pk', 'description')
+            for pk, description in presents.iterator():
+                Present.objects.filter(pk=pk).update(
+                    description_html=render_text(description),
+                    render_version=F('render_version') + 1)
+            comments = Comment.objects.values_list('pk', 'text')
+            for pk, text in comments.iterator():
+                Comment.objects.filter(pk=pk)\
+                               .update(text_html=render_text(text, links=True))
+        self.stdout.write("Updated %d presents and %d comments."
+                          % (presents.count(), comments.count()))
@@ -0,0 +1,220 @@
+import json
+import random
+import time
+from optparse import make_option
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.auth.tokens import default_token_generator
+from django.core.management.base import NoArgsCommand
+from django.core.urlresolvers import reverse
+from django.db import reset_queries
+from django.test.client import Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import (setup_test_environment,
+                               teardown_test_environment)
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+
+from noyel.account.models import EmailAddress
+from noyel.account.urls import urlpatterns as account_patterns
+from noyel.kdo.middleware import QueryTimer
+from noyel.kdo.models import Present, Comment, Invitation, Participant
+from noyel.kdo.urls import urlpatterns as kdo_patterns
+
+PASSWORD = 'benchmark'
+GIFTEES = [u'Zo\xe9', u'Lucas', u'Emma', u'L\xe9o', u'Chlo\xe9', u'Hugo',
+           u'Manon', u'Louis', u'In\xe8s', u'Jules', u'Mamie', u'Papy']
+# Query strings sent to the URLs that need one.
+QUERY_STRINGS = {
+    'kdo-search-giftee': {'q': u'l'},
+    'kdo-search-friend': {'q': u'user'},
+    'kdo-search-present': {'q': u'present example'},
+    'kdo-present-search': {'q': u'present example'},
+}
+
+
+def percentile(values, percent):
+    """Return the given percentile of a list of numbers (nearest rank)."""
+    values = sorted(values)
+    index = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+class Command(NoArgsCommand):
+    help = ("Seed a test database with synthetic data, request every named "
+            "URL of the kdo and account applications and report latency and "
+            "SQL statistics as JSON.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--users', type='int', default=50,
+                    help="Number of users to create."),
+        make_option('--presents', type='int', default=10,
+                    help="Number of presents created by each user."),
+        make_option('--comments', type='int', default=3,
+                    help="Average number of comments on each present."),
+        make_option('--family-size', type='int', default=6,
+                    help="Size of the groups of users sharing presents."),
+        make_option('--repeat', type='int', default=20,
+                    help="Number of requests made to each URL."),
+        make_option('--seed', type='int', default=42,
+                    help="Seed of the random number generator."),
+        make_option('--output', default=None,
+                    help="Write the JSON report to this file instead of "
+                         "the standard output."),
+    )
+    
+    def handle_noargs(self, **options):
+        self.random = random.Random(options['seed'])
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            dataset = self.seed(options)
+            reset_queries()
+            results = self.run(dataset, options['repeat'])
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+        
+        report = json.dumps({
+            'options': dict((key, options[key]) for key in
+                            ['users', 'presents', 'comments', 'family_size',
+                             'repeat', 'seed']),
+            'results': results,
+        }, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
+    
+    def seed(self, options):
+        """Create the synthetic dataset and return a dictionary of the objects
+        used to build the URLs.
+        
+        Users are split in families: presents are mostly shared within a
+        family, sometimes with a member of another family.
+        
+        """
+        rand = self.random
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([
+            User(username='user%d' % i, first_name='User %d' % i,
+                 password=password)
+            for i in range(options['users'])
+        ])
+        users = list(User.objects.order_by('pk'))
+        EmailAddress.objects.bulk_create([
+            EmailAddress(user=user, email='%s@example.com' % user.username,
+                         verified=True)
+            for user in users
+        ])
+        size = max(1, options['family_size'])
+        families = [users[i:i + size] for i in range(0, len(users), size)]
+        
+        for family in families:
+            for user in family:
+                for i in range(options['presents']):
+                    present = Present.objects.create(
+                        title='Present %d of %s' % (i, user.username),
+                        giftee=rand.choice(GIFTEES),
+                        description='A present. http://example.com/%d' % i,
+                        link='http://example.com/%d' % i,
+                    )
+                    participants = set([user])
+                    participants.update(rand.sample(family,
+                                        rand.randint(0, len(family) - 1)))
+                    if rand.random() < 0.1:
+                        participants.add(rand.choice(users))
+                    for participant in participants:
+                        Participant.objects.create(present=present,
+                                                   user=participant)
+                    participants = list(participants)
+                    for j in range(rand.randint(0, 2 * options['comments'])):
+                        Comment.objects.create(present=present,
+                                               author=rand.choice(participants),
+                                               text='Comment %d: http://example.com' % j)
+                    if rand.random() < 0.2:
+                        Invitation.objects.create(
+                            present=present, sent_by=user,
+                            sent_to='%s@example.com' % rand.choice(users).username)
+        
+        user = users[0]
+        present = Present.objects.filter(participants__user=user)\
+                                 .order_by('-participant_count')[0]
+        unverified = EmailAddress.objects.create(user=user,
+                                                 email='unverified@example.com')
+        return {
+            'user': user,
+            'present': present,
+            'participant': present.participants.exclude(user=user)[0].user
+                           if present.participant_count > 1 else user,
+            'comment': Comment.objects.filter(author=user)[0],
+            'invitation': Invitation.objects.filter(
+                              present__participants__user=user)[0],
+            'email': unverified,
+        }
+    
+    def get_kwargs(self, name, keys, dataset):
+        """Return the URL keyword arguments for the given URL name."""
+        user, present = dataset['user'], dataset['present']
+        values = {
+            'pk': dataset['comment'].pk if name in ('kdo-comment-update',
+                                                   'kdo-comment-delete')
+                  else present.pk,
+            'user_pk': dataset['participant'].pk,
+            'giftee': present.giftee,
+            'email': dataset['email'].email,
+            'uidb64': urlsafe_base64_encode(force_bytes(user.pk)),
+        }
+        if name == 'kdo-email-verify':
+            values['token'] = dataset['email'].make_hash()
+        elif name == 'password-reset-confirm':
+            values['token'] = default_token_generator.make_token(user)
+        else:
+            values['token'] = dataset['invitation'].token
+        return dict((key, values[key]) for key in keys)
+    
+    def run(self, dataset, repeat):
+        """Request every named URL `repeat` times as the dataset's user and
+        return the statistics for each one.
+        
+        """
+        client = Client()
+        results = []
+        for pattern in kdo_patterns + account_patterns:
+            if not pattern.name:
+                continue
+            keys = pattern.regex.groupindex.keys()
+            url = reverse(pattern.name,
+                          kwargs=self.get_kwargs(pattern.name, keys, dataset))
+            timings, sql_timings, queries = [], [], []
+            try:
+                for i in range(repeat):
+                    if '_auth_user_id' not in client.session:
+                        client.login(username=dataset['user'].username,
+                                     password=PASSWORD)
+                    with QueryTimer() as timer:
+                        start = time.time()
+                        # Some views redirect to the referer when no
+                        # `next` parameter is given.
+                        response = client.get(url,
+                                              QUERY_STRINGS.get(pattern.name, {}),
+                                              HTTP_REFERER=url)
+                        timings.append((time.time() - start) * 1000)
+                    queries.append(timer.count)
+                    sql_timings.append(timer.duration * 1000)
+            except Exception as e: # the test client re-raises view errors
+                results.append({'name': pattern.name, 'url': url,
+                                'status': 500, 'error': repr(e)})
+                continue
+            results.append({
+                'name': pattern.name,
+                'url': url,
+                'status': response.status_code,
+                'p50_ms': round(percentile(timings, 50), 3),
+                'p95_ms': round(percentile(timings, 95), 3),
+                'queries': max(queries),
+                'sql_ms': round(percentile(sql_timings, 50), 3),
+            })
+        return results
@@ -0,0 +1,54 @@
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from noyel.kdo import export
+from noyel.kdo.forms import ExportForm
+
+
+class Command(BaseCommand):
+    args = '<username>'
+    help = ("Export the presents of the given user (with their participants, "
+            "comments, invitations and purchase information) as CSV or "
+            "NDJSON.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default='csv',
+                    help="Output format: csv or ndjson."),
+        make_option('--giftee', help="Only export the presents for this "
+                                     "giftee."),
+        make_option('--status', help="Only export the presents with this "
+                                     "status (as a number)."),
+        make_option('--since', help="Only export the presents created on or "
+                                    "after this date (YYYY-MM-DD)."),
+        make_option('--until', help="Only export the presents created on or "
+                                    "before this date (YYYY-MM-DD)."),
+        make_option('--output', default=None,
+                    help="Write the export to this file instead of the "
+                         "standard output."),
+    )
+    
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give exactly one username.")
+        try:
+            user = User.objects.get(username=args[0])
+        except User.DoesNotExist:
+            raise CommandError("No user named %r." % args[0])
+        
+        form = ExportForm(dict((key, options[key]) for key in
+                               ['format', 'giftee', 'status', 'since', 'until']
+                               if options[key] is not None))
+        if not form.is_valid():
+            raise CommandError(form.errors.as_text())
+        filters = form.cleaned_data.copy()
+        format = filters.pop('format')
+        
+        presents = export.get_presents(user, **filters)
+        lines = export.export(export.iter_presents(presents), format)
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from noyel.kdo import importer
+
+
+class Command(BaseCommand):
+    args = '<username> <file>'
+    help = ("Create presents for the given user from a CSV or JSON file "
+            "(with title, giftee, description, link and price columns).")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default=None,
+                    help="csv or json (guessed from the file name by "
+                         "default)."),
+    )
+    
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Give a username and a file name.")
+        username, filename = args
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError("No user named %r." % username)
+        
+        format = options['format'] or \
+                 ('json' if filename.lower().endswith('.json') else 'csv')
+        with open(filename, 'rb') as f:
+            data = f.read()
+        try:
+            rows = importer.parse(data, format)
+        except importer.InvalidImport as e:
+            raise CommandError(unicode(e))
+        
+        created, errors, skipped = importer.import_presents(user, rows)
+        for number, row_errors in errors:
+            for field, messages in row_errors.items():
+                self.stderr.write("Row %d: %s: %s" % (number, field,
+                                                      u" ".join(messages)))
+        self.stdout.write("Imported %d presents (%d skipped, %d invalid)."
+                          % (len(created), len(skipped), len(errors)))
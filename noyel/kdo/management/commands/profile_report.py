@@ -0,0 +1,45 @@
+import os
+import pstats
+from StringIO import StringIO
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from noyel.kdo.middleware import list_profiles, make_profiling_token
+
+
+class Command(BaseCommand):
+    args = '[url_name url_name ...]'
+    help = ("Aggregate the profiles written by ProfilingMiddleware and print "
+            "the functions with the highest cumulative time for each URL "
+            "name (all of them by default).")
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=20,
+                    help="Number of functions shown for each URL name."),
+        make_option('--sort', default='cumulative',
+                    help="pstats sort key (cumulative, time, calls...)."),
+        make_option('--token', action='store_true', default=False,
+                    help="Print a token for the X-Kdo-Profile header "
+                         "instead."),
+    )
+    
+    def handle(self, *names, **options):
+        if options['token']:
+            self.stdout.write(make_profiling_token())
+            return
+        
+        directory = settings.KDO_PROFILING_DIR
+        if not names:
+            names = sorted(os.listdir(directory)) \
+                    if os.path.isdir(directory) else []
+        for name in names:
+            profiles = list_profiles(os.path.join(directory, name))
+            if not profiles:
+                continue
+            self.stdout.write("%s (%d profiles)" % (name, len(profiles)))
+            # pstats writes partial lines which self.stdout would break up.
+            output = StringIO()
+            stats = pstats.Stats(*profiles, stream=output)
+            stats.sort_stats(options['sort']).print_stats(options['limit'])
+            self.stdout.write(output.getvalue())
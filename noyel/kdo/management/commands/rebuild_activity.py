@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+
+from noyel.kdo.models import ActivityEvent
+
+
+class Command(NoArgsCommand):
+    help = ("Rebuild the activity feeds of all users from the participants "
+            "of presents and their comments.")
+    
+    def handle_noargs(self, **options):
+        count = ActivityEvent.objects.rebuild()
+        self.stdout.write("Created %d activity events." % count)
@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+
+from noyel.kdo.models import Friendship
+
+
+class Command(NoArgsCommand):
+    help = "Rebuild the friendship graph from the participants of presents."
+    
+    def handle_noargs(self, **options):
+        count = Friendship.objects.rebuild()
+        self.stdout.write("Created %d friendships." % count)
@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+
+from noyel.kdo.models import GifteeEntry
+
+
+class Command(NoArgsCommand):
+    help = "Rebuild the per-user giftee index used for autocompletion."
+    
+    def handle_noargs(self, **options):
+        count = GifteeEntry.objects.rebuild()
+        self.stdout.write("Created %d giftee entries." % count)
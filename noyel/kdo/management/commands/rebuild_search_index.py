@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+
+from noyel.kdo.models import SearchTerm
+
+
+class Command(NoArgsCommand):
+    help = ("Rebuild the search index from the titles, descriptions and links "
+            "of all presents and the text of all comments.")
+    
+    def handle_noargs(self, **options):
+        count = SearchTerm.objects.rebuild()
+        self.stdout.write("Created %d search terms." % count)
@@ -0,0 +1,28 @@
+from django.core.management.base import NoArgsCommand
+from django.db.models import Count, F
+
+from noyel.kdo.models import Present
+
+
+class Command(NoArgsCommand):
+    help = ("Recompute the comment and participant counters of all presents "
+            "and fix the ones that drifted.")
+    
+    def handle_noargs(self, **options):
+        presents = Present.objects.annotate(
+            actual_comments=Count('comment', distinct=True),
+            actual_participants=Count('participants', distinct=True),
+        ).values_list('pk', 'actual_comments', 'actual_participants',
+                      'comment_count', 'participant_count')
+        fixed = 0
+        for pk, comments, participants, comment_count, participant_count \
+                in presents.iterator():
+            if (comments, participants) == (comment_count, participant_count):
+                continue
+            # Bump the render version too: the counts appear in the cached
+            # template fragments.
+            Present.objects.filter(pk=pk).update(
+                comment_count=comments, participant_count=participants,
+                render_version=F('render_version') + 1)
+            fixed += 1
+        self.stdout.write("Fixed the counters of %d presents." % fixed)
@@ -0,0 +1,31 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from noyel.kdo.models import OutboundEmail
+
+
+class Command(NoArgsCommand):
+    help = ("Send the emails waiting in the outbox, in batches over a single "
+            "connection.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+                    help="Number of emails sent over each connection."),
+        make_option('--loop', action='store_true', default=False,
+                    help="Keep running and poll the outbox for new emails."),
+        make_option('--interval', type='float', default=10,
+                    help="Seconds to wait between polls in --loop mode."),
+    )
+    
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        while True:
+            sent, failed = OutboundEmail.objects.send_due(batch_size)
+            if sent or failed:
+                self.stdout.write("Sent %d emails (%d failed)." % (sent, failed))
+            if sent + failed == batch_size:
+                continue # there might be more waiting
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
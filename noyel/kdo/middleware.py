@@ -0,0 +1,305 @@
+import cProfile
+import logging
+import os
+import random
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from noyel.kdo.cache import delete_pending_keys
+
+logger = logging.getLogger('noyel.kdo.instrumentation')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class CacheInvalidationMiddleware(object):
+    """Delete again the cache keys invalidated inside a transaction, once the
+    view is done and the transaction is committed (see
+    noyel.kdo.cache.delete_after_commit).
+    
+    It must be the first middleware so that it runs after all the others.
+    The keys left by the code run outside a request (like the tests) are
+    deleted before the request.
+    
+    """
+    def process_request(self, request):
+        delete_pending_keys()
+    
+    def process_response(self, request, response):
+        delete_pending_keys()
+        return response
+
+
+class TimedCursor(object):
+    """A cursor proxy adding the duration of each query to a QueryTimer."""
+    def __init__(self, cursor, timer):
+        self.cursor = cursor
+        self.timer = timer
+    
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+    
+    def __iter__(self):
+        return iter(self.cursor)
+    
+    def execute(self, *args, **kwargs):
+        return self.timer.time(self.cursor.execute, *args, **kwargs)
+    
+    def executemany(self, *args, **kwargs):
+        return self.timer.time(self.cursor.executemany, *args, **kwargs)
+
+
+class QueryTimer(object):
+    """Count the SQL queries run on a database connection and measure the
+    time they take.
+    
+    connection.queries can't be used for this: it rounds the duration of
+    each query to the millisecond, so most queries take 0 seconds.
+    
+    Use it as a context manager, or call start() and stop().
+    
+    """
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.count = 0
+        self.duration = 0.0 # in seconds
+    
+    def start(self):
+        self.connection = connections[self.using]
+        self.patched = 'cursor' in self.connection.__dict__
+        self.cursor = self.connection.cursor
+        self.connection.cursor = lambda: TimedCursor(self.cursor(), self)
+    
+    def stop(self):
+        if self.patched: # by an enclosing timer
+            self.connection.cursor = self.cursor
+        else:
+            del self.connection.cursor
+    
+    def __enter__(self):
+        self.start()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+    
+    def time(self, method, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.count += 1
+            self.duration += time.time() - start
+
+
+class InstrumentationMiddleware(object):
+    """Measure the SQL queries, the template rendering time and the total time
+    spent on each request.
+    
+    The measures are sent back in a `Server-Timing` header and logged to the
+    `noyel.kdo.instrumentation` logger along with the name of the resolved
+    URL (like `kdo-present-detail`).
+    
+    The middleware is only used if the KDO_INSTRUMENTATION setting is True.
+    KDO_QUERY_BUDGETS maps URL names to the maximum number of queries their
+    view may run: a warning is logged when a view goes over its budget, or a
+    QueryBudgetExceeded exception is raised if KDO_QUERY_BUDGET_RAISE is True
+    (which is meant for the tests).
+    
+    """
+    def __init__(self):
+        if not getattr(settings, 'KDO_INSTRUMENTATION', False):
+            raise MiddlewareNotUsed
+    
+    def process_request(self, request):
+        timer = QueryTimer()
+        request._instrumentation = {
+            'start': time.time(),
+            'timer': timer,
+            'template': 0.0,
+        }
+        timer.start()
+    
+    def process_template_response(self, request, response):
+        """Time the rendering of the template, which happens right after the
+        template response middlewares are run.
+        
+        """
+        data = getattr(request, '_instrumentation', None)
+        if data is not None:
+            data['template_start'] = time.time()
+            response.add_post_render_callback(
+                lambda response: self._rendered(data))
+        return response
+    
+    def _rendered(self, data):
+        data['template'] += time.time() - data.pop('template_start')
+    
+    def process_response(self, request, response):
+        data = getattr(request, '_instrumentation', None)
+        if data is None: # an earlier middleware short-circuited the request
+            return response
+        del request._instrumentation
+        timer = data['timer']
+        timer.stop()
+        
+        match = getattr(request, 'resolver_match', None)
+        stats = {
+            'view': match.url_name if match else None,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': timer.count,
+            'sql': timer.duration * 1000,
+            'template': data['template'] * 1000,
+            'total': (time.time() - data['start']) * 1000,
+        }
+        response['Server-Timing'] = ', '.join([
+            'sql;dur=%.3f;desc="%d queries"' % (stats['sql'], stats['queries']),
+            'template;dur=%.1f' % stats['template'],
+            'total;dur=%.1f' % stats['total'],
+        ])
+        logger.info('view=%(view)s path=%(path)s status=%(status)d '
+                    'queries=%(queries)d sql_ms=%(sql).3f '
+                    'template_ms=%(template).1f total_ms=%(total).1f',
+                    stats, extra={'instrumentation': stats})
+        
+        budget = getattr(settings, 'KDO_QUERY_BUDGETS', {}).get(stats['view'])
+        if budget is not None and stats['queries'] > budget:
+            msg = '%s ran %d queries (budget: %d)' % (stats['view'],
+                                                      stats['queries'], budget)
+            if getattr(settings, 'KDO_QUERY_BUDGET_RAISE', False):
+                raise QueryBudgetExceeded(msg)
+            logger.warning(msg, extra={'instrumentation': stats})
+        return response
+
+
+PROFILING_HEADER = 'HTTP_X_KDO_PROFILE'
+PROFILING_SALT = 'noyel.kdo.profiling'
+
+
+def make_profiling_token():
+    """Return a value for the X-Kdo-Profile header that makes
+    ProfilingMiddleware profile the request. The token is valid for
+    KDO_PROFILING_TOKEN_MAX_AGE seconds.
+    
+    """
+    return signing.dumps('profile', salt=PROFILING_SALT)
+
+
+class ProfilingMiddleware(object):
+    """Profile a sample of the requests with cProfile.
+    
+    The middleware is only used if the KDO_PROFILING setting is True. A
+    request is profiled with a probability of KDO_PROFILING_SAMPLE_RATE, or
+    when it carries a valid X-Kdo-Profile header (see make_profiling_token).
+    
+    The profiles are written in a directory per URL name under
+    KDO_PROFILING_DIR. Only the KDO_PROFILING_MAX_FILES most recent profiles
+    of each URL name are kept, and the oldest ones are removed when all the
+    profiles take more than KDO_PROFILING_MAX_SIZE bytes.
+    
+    The `profile_report` management command aggregates them.
+    
+    """
+    def __init__(self):
+        if not getattr(settings, 'KDO_PROFILING', False):
+            raise MiddlewareNotUsed
+        self.directory = settings.KDO_PROFILING_DIR
+    
+    def should_profile(self, request):
+        token = request.META.get(PROFILING_HEADER)
+        if token:
+            max_age = getattr(settings, 'KDO_PROFILING_TOKEN_MAX_AGE', 60 * 60)
+            try:
+                return signing.loads(token, salt=PROFILING_SALT,
+                                     max_age=max_age) == 'profile'
+            except signing.BadSignature:
+                return False
+        rate = getattr(settings, 'KDO_PROFILING_SAMPLE_RATE', 0)
+        return random.random() < rate
+    
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """Start profiling once the URL is resolved so that the profile
+        covers the view and the rendering of its template.
+        
+        """
+        if self.should_profile(request):
+            request._profiler = cProfile.Profile()
+            request._profiler.enable()
+    
+    def process_response(self, request, response):
+        profiler = getattr(request, '_profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        del request._profiler
+        
+        name = request.resolver_match.url_name or 'unnamed'
+        directory = os.path.join(self.directory, name)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = os.path.join(directory, '%f-%d.prof' % (time.time(),
+                                                           os.getpid()))
+        profiler.dump_stats(filename)
+        self.rotate(directory)
+        return response
+    
+    def rotate(self, directory):
+        """Remove the oldest profiles of the given directory then the oldest
+        profiles of all the directories until the size cap is honored.
+        
+        """
+        max_files = getattr(settings, 'KDO_PROFILING_MAX_FILES', 20)
+        for filename in list_profiles(directory)[:-max_files]:
+            remove_profile(filename)
+        
+        max_size = getattr(settings, 'KDO_PROFILING_MAX_SIZE', 50 * 1024 * 1024)
+        profiles = stat_profiles(self.directory)
+        total = sum(stat.st_size for filename, stat in profiles)
+        for filename, stat in profiles:
+            if total <= max_size:
+                break
+            total -= stat.st_size
+            remove_profile(filename)
+
+
+def stat_profiles(directory):
+    """Return a (path, stat result) tuple for each profile under the given
+    directory, oldest first.
+    
+    Other processes rotate the same directories: the profiles they remove
+    while the directory is walked are skipped.
+    
+    """
+    profiles = []
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            if not f.endswith('.prof'):
+                continue
+            filename = os.path.join(root, f)
+            try:
+                profiles.append((filename, os.stat(filename)))
+            except OSError: # removed by another process
+                pass
+    return sorted(profiles, key=lambda profile: profile[1].st_mtime)
+
+
+def list_profiles(directory):
+    """Return the paths of all the profiles under the given directory, oldest
+    first.
+    
+    """
+    return [filename for filename, stat in stat_profiles(directory)]
+
+
+def remove_profile(filename):
+    try:
+        os.remove(filename)
+    except OSError: # another process removed it already
+        pass
@@ -1,6 +1,16 @@
+import base64
+
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.db.models import Q
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.utils.dateparse import parse_datetime
 from django.utils.decorators import method_decorator
 
+from noyel.kdo.models import Present, Participant, SearchTerm
+from noyel.kdo.utils import highlight
+
 login_required = method_decorator(login_required)
 
 
@@ -17,3 +27,167 @@ class UserQuerysetMixin(object):
     def get_queryset(self):
         base = super(UserQuerysetMixin, self).get_queryset()
         return base.filter(**{self.user_field_name: self.request.user})
+
+
+def get_present_or_404(user, pk):
+    """Return the present with the given pk, or raise Http404 if the given
+    user doesn't participate in it.
+    
+    The check uses the user's cached present ids (see
+    ParticipantManager.present_ids) instead of joining the participants.
+    
+    """
+    if int(pk) not in Participant.objects.present_ids(user):
+        raise Http404
+    return get_object_or_404(Present, pk=pk)
+
+
+class PresentAccessMixin(object):
+    """Only give access to the objects (presents, or objects with a
+    `present_field_name` foreign key to a present) of the presents the current
+    user participates in. Other objects raise Http404.
+    
+    This replaces UserQuerysetMixin's join on the participants with a lookup
+    in the user's cached present ids, which relies on a cache shared by all
+    the processes (see noyel.kdo.cache.check_cache_backend).
+    
+    """
+    present_field_name = None
+    
+    def get_object(self, queryset=None):
+        present_ids = Participant.objects.present_ids(self.request.user)
+        pk = self.kwargs.get(self.pk_url_kwarg)
+        # Presents are checked before being loaded along with everything
+        # their queryset prefetches.
+        if self.present_field_name is None and pk is not None and \
+           int(pk) not in present_ids:
+            raise Http404
+        obj = super(PresentAccessMixin, self).get_object(queryset)
+        if self.present_field_name is None:
+            present_id = obj.pk
+        else:
+            present_id = getattr(obj, '%s_id' % self.present_field_name)
+        if present_id not in present_ids:
+            raise Http404
+        return obj
+
+
+class KeysetPaginationMixin(object):
+    """Paginate a ListView, newest first, using a cursor on the
+    (`cursor_field`, pk) pair instead of an OFFSET so that deep pages are as
+    fast as the first one.
+    
+    The cursor is passed as an opaque token in the `cursor` parameter of the
+    query string. The size of the pages is taken from the
+    KDO_PRESENTS_PER_PAGE setting.
+    
+    """
+    cursor_field = 'updated_on'
+    cursor_kwarg = 'cursor'
+    
+    def get_page_size(self):
+        return getattr(settings, 'KDO_PRESENTS_PER_PAGE', 50)
+    
+    def encode_cursor(self, direction, obj):
+        value = getattr(obj, self.cursor_field)
+        token = '%s|%s|%s' % (direction, value.isoformat(), obj.pk)
+        return base64.urlsafe_b64encode(token)
+    
+    def decode_cursor(self, token):
+        """Return a (direction, value, pk) tuple for the given token.
+        Raise Http404 if the token is invalid.
+        
+        """
+        try:
+            direction, value, pk = base64.urlsafe_b64decode(str(token))\
+                                         .split('|')
+            value, pk = parse_datetime(value), int(pk)
+        except (TypeError, ValueError):
+            raise Http404
+        if direction not in ('next', 'previous') or value is None:
+            raise Http404
+        return direction, value, pk
+    
+    def get_page_url(self, token):
+        """Return the URL of the current page with the given cursor."""
+        params = self.request.GET.copy()
+        params[self.cursor_kwarg] = token
+        return '?%s' % params.urlencode()
+    
+    def paginate_keyset(self, queryset):
+        """Return the objects of the page selected by the current cursor along
+        with the URLs of the previous and next pages (None if there are no
+        such pages).
+        
+        """
+        field, size = self.cursor_field, self.get_page_size()
+        token = self.request.GET.get(self.cursor_kwarg)
+        direction = None
+        if token:
+            direction, value, pk = self.decode_cursor(token)
+            lookup = 'gt' if direction == 'previous' else 'lt'
+            queryset = queryset.filter(
+                Q(**{'%s__%s' % (field, lookup): value}) |
+                Q(**{field: value, 'pk__%s' % lookup: pk})
+            )
+        
+        if direction == 'previous':
+            queryset = queryset.order_by(field, 'pk')
+        else:
+            queryset = queryset.order_by('-%s' % field, '-pk')
+        
+        objects = list(queryset[:size + 1])
+        has_more, objects = len(objects) > size, objects[:size]
+        if direction == 'previous':
+            objects.reverse()
+            has_previous, has_next = has_more, True
+        else:
+            has_previous, has_next = direction == 'next', has_more
+        
+        previous_url = next_url = None
+        if objects and has_previous:
+            previous_url = self.get_page_url(
+                self.encode_cursor('previous', objects[0]))
+        if objects and has_next:
+            next_url = self.get_page_url(
+                self.encode_cursor('next', objects[-1]))
+        return objects, previous_url, next_url
+    
+    def get_context_data(self, **kwargs):
+        queryset = kwargs.pop('object_list', self.object_list)
+        objects, previous_url, next_url = self.paginate_keyset(queryset)
+        context = super(KeysetPaginationMixin, self).get_context_data(
+            object_list=objects, **kwargs)
+        context.update({
+            'is_paginated': bool(previous_url or next_url),
+            'previous_page_url': previous_url,
+            'next_page_url': next_url,
+        })
+        return context
+
+
+class PresentSearchMixin(object):
+    """Search the current user's presents for the words of the `q` parameter
+    of the query string.
+    
+    Each result gets a highlighted `title_html` and an `excerpt_html` of its
+    best matching comment (or of its description).
+    
+    """
+    query_kwarg = 'q'
+    excerpt_length = 200
+    
+    def get_query(self):
+        return self.request.GET.get(self.query_kwarg, u'').strip()
+    
+    def get_results(self):
+        results = SearchTerm.objects.search(self.request.user,
+                                            self.get_query())
+        for present in results:
+            present.title_html = highlight(present.title, present.terms)
+            text = present.description
+            if present.matching_comment is not None:
+                text = present.matching_comment.text
+            present.excerpt_html = highlight(text, present.terms,
+                                             self.excerpt_length)
+        return results
@@ -1,14 +1,24 @@
+import json
+from collections import defaultdict
 from datetime import timedelta
 
-from django.db import models
+from django.db import models, router, transaction, IntegrityError
+from django.db.models import F, Max, Sum
+from django.db.models.signals import pre_save, post_save
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
 from django.utils.translation import ugettext_lazy as _, pgettext_lazy
 from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.utils.functional import curry
 from django.contrib.sites.models import get_current_site
 
+from noyel.account.utils import get_friends_for_user
+from noyel.kdo.cache import (invitation_count_key, INVITATION_COUNT_TIMEOUT,
+                             present_ids_key, PRESENT_IDS_TIMEOUT)
 from noyel.kdo.emails import InvitationEmail
+from noyel.kdo.utils import normalize_giftee, render_text, tokenize
 
 
 class Present(models.Model):
@@ -28,7 +38,13 @@ class Present(models.Model):
         ]
     title = models.CharField(_("title"), max_length=50)
     giftee = models.CharField(_("giftee"), max_length=100)
+    # Normalized version of the giftee, used for lookups (see normalize_giftee)
+    giftee_key = models.CharField(_("giftee key"), max_length=100,
+                                  db_index=True, editable=False)
     description = models.TextField(_("description"), blank=True)
+    # Rendered version of the description, computed in save()
+    description_html = models.TextField(_("description (HTML)"), blank=True,
+                                        editable=False)
     link = models.URLField(_("link"), blank=True)
     price = models.DecimalField(_("price"), max_digits=6, decimal_places=2,
                 blank=True, null=True)
@@ -37,6 +53,21 @@ class Present(models.Model):
     bought_by = models.ForeignKey('auth.User', verbose_name=_("bought by"),
                                   blank=True, null=True,
                                   related_name='purchased_set')
+    # Denormalized counters, maintained by the receivers in noyel.kdo.signals
+    comment_count = models.PositiveIntegerField(_("number of comments"),
+                                                default=0, editable=False)
+    participant_count = models.PositiveIntegerField(
+                            _("number of participants"),
+                            default=0, editable=False)
+    # Bumped whenever the present's comments, participants or invitations
+    # change (see noyel.kdo.signals). Together with updated_on, it versions
+    # the cached template fragments of the present.
+    render_version = models.PositiveIntegerField(_("render version"),
+                                                 default=0, editable=False)
+    # Bumped whenever the present itself is saved, so that concurrent edits
+    # can be detected (see save_if_unchanged).
+    version = models.PositiveIntegerField(_("version"), default=0,
+                                          editable=False)
     
     created_on = models.DateTimeField(_("added on"), auto_now_add=True)
     updated_on = models.DateTimeField(_("updated on"), auto_now=True)
@@ -44,17 +75,90 @@ class Present(models.Model):
     class Meta:
         verbose_name = _("present")
         verbose_name_plural = _("presents")
+        # See also the index on (status, updated_on) in sql/present.*.sql
     
     def __unicode__(self):
         return self.title
     
+    # Only ever changed with increment_counter, never written by save(): the
+    # values of an instance loaded earlier would overwrite the current ones.
+    COUNTER_FIELDS = ['comment_count', 'participant_count', 'render_version']
+    
+    def save(self, *args, **kwargs):
+        self.compute_fields()
+        if self._state.adding or args or kwargs.get('force_insert'):
+            return super(Present, self).save(*args, **kwargs)
+        if kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in
+                                       self._meta.concrete_fields
+                                       if not f.primary_key and
+                                       f.name not in self.COUNTER_FIELDS]
+        # Increment the version in the UPDATE itself: a stale instance would
+        # otherwise write back an older version.
+        version, self.version = self.version, F('version') + 1
+        try:
+            super(Present, self).save(**kwargs)
+        except Exception:
+            self.version = version
+            raise
+        self.version = Present.objects.filter(pk=self.pk)\
+                                      .values_list('version', flat=True)[0]
+    
+    def save_if_unchanged(self, version, fields, **conditions):
+        """Save the given fields of the present with a single
+        UPDATE ... WHERE, only if the row still has the given version and
+        matches the given lookups. Return whether the present was saved.
+        
+        This lets concurrent edits fail instead of silently overwriting each
+        other, without locking the row. The pre_save and post_save signals are
+        sent like save() does.
+        
+        """
+        self.compute_fields()
+        self.updated_on = timezone.now()
+        fields = list(fields) + ['giftee_key', 'description_html',
+                                 'updated_on']
+        using = router.db_for_write(Present, instance=self)
+        pre_save.send(sender=Present, instance=self, raw=False, using=using,
+                      update_fields=fields)
+        
+        qs = Present.objects.filter(pk=self.pk, version=version, **conditions)
+        values = dict((name, getattr(self, name)) for name in fields)
+        if not qs.update(version=F('version') + 1, **values):
+            return False
+        
+        self.version = version + 1
+        post_save.send(sender=Present, instance=self, created=False,
+                       raw=False, using=using, update_fields=fields)
+        return True
+    
+    def compute_fields(self):
+        """Fill in the fields derived from the others. This is done by save()
+        but must be called explicitly before a bulk_create.
+        
+        """
+        self.giftee_key = normalize_giftee(self.giftee)
+        self.description_html = render_text(self.description)
+    
+    @classmethod
+    def increment_counter(cls, pk, field, delta=1):
+        """Atomically add `delta` to the given counter of the given present.
+        The counter is never decremented below zero.
+        
+        """
+        qs = cls.objects.filter(pk=pk)
+        if delta < 0:
+            qs = qs.filter(**{'%s__gte' % field: -delta})
+        qs.update(**{field: F(field) + delta})
+    
     def matching_giftee(self, user=None):
-        """Return a queryset of presents that have the same giftee as this one.
+        """Return a queryset of presents that have the same giftee as this one
+        (ignoring case, accents and extra whitespace).
         If a user is passed, restrict to presents for which the user is listed
         in the participants.
         
         """
-        qs = self.__class__.objects.filter(giftee__iexact=self.giftee).exclude(pk=self.pk)
+        qs = self.__class__.objects.filter(giftee_key=self.giftee_key).exclude(pk=self.pk)
         if user is not None:
             qs = qs.filter(participants__user=user)
         return qs
@@ -64,14 +168,15 @@ class Present(models.Model):
         with the given user, but that are not participating to the current one.
         
         """
-        return User.objects.exclude(present=self)\
-                           .filter(present__participants__user=user)
+        return get_friends_for_user(user).exclude(participant__present=self)
 
 
 class Comment(models.Model):
     present = models.ForeignKey('kdo.Present', verbose_name=_('present'))
     author = models.ForeignKey('auth.User', verbose_name=_("author"))
     text = models.TextField(_("text"))
+    # Rendered version of the text (with links), computed in save()
+    text_html = models.TextField(_("text (HTML)"), blank=True, editable=False)
     posted_on = models.DateTimeField(_("posted on"), auto_now_add=True)
     
     def __unicode__(self):
@@ -81,10 +186,16 @@ class Comment(models.Model):
         else:
             return self.text
     
+    def save(self, *args, **kwargs):
+        self.text_html = render_text(self.text, links=True)
+        return super(Comment, self).save(*args, **kwargs)
+    
     class Meta:
         verbose_name = _("comment")
         verbose_name_plural = _("comments")
         ordering = ['-posted_on']
+        # The comments of a present, newest first
+        index_together = [('present', 'posted_on')]
 
 
 class InvitationManager(models.Manager):
@@ -92,6 +203,19 @@ class InvitationManager(models.Manager):
         """Return invitations for the given user."""
         q = Invitation.Q_for_user(user)
         return self.get_query_set().filter(q)
+    
+    def count_for_user(self, user):
+        """Return the number of invitations for the given user.
+        The value is cached until an invitation or one of the user's email
+        addresses changes (see noyel.kdo.signals).
+        
+        """
+        key = invitation_count_key(user.pk)
+        count = cache.get(key)
+        if count is None:
+            count = self.for_user(user).count()
+            cache.set(key, count, INVITATION_COUNT_TIMEOUT)
+        return count
 
 
 class Invitation(models.Model):
@@ -99,7 +223,8 @@ class Invitation(models.Model):
     token = models.CharField(_("token"), max_length=TOKEN_SIZE, primary_key=True, default=curry(get_random_string, TOKEN_SIZE))
     present = models.ForeignKey('kdo.Present', verbose_name=_("present"))
     sent_by = models.ForeignKey('auth.User', verbose_name=pgettext_lazy("invitation", "sent by"))
-    sent_to = models.EmailField(pgettext_lazy("invitation", "sent to"))
+    sent_to = models.EmailField(pgettext_lazy("invitation", "sent to"),
+                                db_index=True)
     sent_on = models.DateTimeField(pgettext_lazy("invitation", "sent on"), auto_now_add=True)
     
     objects = InvitationManager()
@@ -132,15 +257,666 @@ class Invitation(models.Model):
             })
     
     def send_email(self, request):
+        """Queue the invitation email in the outbox."""
         message = self.get_message(request)
-        return message.send()
+        return OutboundEmail.objects.queue(message)
+
+
+class ParticipantManager(models.Manager):
+    def present_ids(self, user):
+        """Return the set of the ids of the presents the given user
+        participates in, which are the presents they can access.
+        The value is cached until one of the user's participations is added
+        or removed (see noyel.kdo.signals).
+        
+        """
+        key = present_ids_key(user.pk)
+        ids = cache.get(key)
+        if ids is None:
+            ids = frozenset(self.filter(user=user)
+                                .values_list('present', flat=True))
+            cache.set(key, ids, PRESENT_IDS_TIMEOUT)
+        return ids
 
 
 class Participant(models.Model):
     present = models.ForeignKey(Present, related_name='participants')
     user = models.ForeignKey('auth.User')
     
+    objects = ParticipantManager()
+    
     class Meta:
         verbose_name = _("participant")
         verbose_name_plural = _("participants")
         unique_together = ('present', 'user')
+        # The presents of a user (the unique index starts with the present)
+        index_together = [('user', 'present')]
+
+
+
+class FriendshipManager(models.Manager):
+    def participants_added(self, present, user_ids):
+        """Record that the given users (which have just been added to the
+        present) now share the given present with all its other participants.
+        
+        """
+        others = Participant.objects.filter(present=present)\
+                                    .exclude(user__in=user_ids)\
+                                    .values_list('user', flat=True)
+        others = list(others)
+        for user_id in user_ids:
+            self._add_edges(user_id, others, present.created_on)
+            others.append(user_id)
+    
+    def participant_removed(self, present_id, user_id):
+        """Record that the given user no longer shares the given present with
+        its remaining participants.
+        
+        """
+        others = Participant.objects.filter(present=present_id)\
+                                    .exclude(user=user_id)\
+                                    .values_list('user', flat=True)
+        self._remove_edges(user_id, list(others), present_id)
+    
+    def present_removed(self, present_id):
+        """Forget about all the friendships created by the given present.
+        This needs to be called before the participants are deleted.
+        
+        """
+        users = list(Participant.objects.filter(present=present_id)\
+                                        .values_list('user', flat=True))
+        for user_id in users:
+            others = [pk for pk in users if pk != user_id]
+            self.filter(user=user_id, friend__in=others,
+                        shared_present_count__gt=0)\
+                .update(shared_present_count=F('shared_present_count') - 1)
+        self.filter(user__in=users, shared_present_count=0).delete()
+        for user_id in users:
+            others = [pk for pk in users if pk != user_id]
+            self._update_last_shared_on(user_id, others, present_id)
+    
+    def rebuild(self):
+        """Delete all friendships and re-create them from the participants
+        table. Return the number of friendships created.
+        
+        """
+        edges = {}
+        rows = Participant.objects.values_list('user',
+                                               'present__participants__user',
+                                               'present__created_on')
+        for user_id, friend_id, shared_on in rows.iterator():
+            if user_id == friend_id:
+                continue
+            count, last_shared_on = edges.get((user_id, friend_id),
+                                              (0, shared_on))
+            edges[user_id, friend_id] = (count + 1,
+                                         max(last_shared_on, shared_on))
+        
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create([
+                self.model(user_id=user_id, friend_id=friend_id,
+                           shared_present_count=count,
+                           last_shared_on=last_shared_on)
+                for (user_id, friend_id), (count, last_shared_on)
+                in edges.iteritems()
+            ], batch_size=500)
+        return len(edges)
+    
+    def _edges(self, user_id, friend_ids):
+        """Return the friendships between the given user and the given
+        friends, in both directions.
+        
+        """
+        return self.filter(models.Q(user=user_id, friend__in=friend_ids) |
+                           models.Q(user__in=friend_ids, friend=user_id))
+    
+    def _add_edges(self, user_id, friend_ids, shared_on):
+        """Increment the friendships between the given user and each given
+        friend (in both directions), creating the missing ones.
+        `shared_on` is the creation date of the shared present: last_shared_on
+        is the creation date of the most recent shared present.
+        
+        """
+        if not friend_ids:
+            return
+        edges = self._edges(user_id, friend_ids)
+        edges.update(shared_present_count=F('shared_present_count') + 1)
+        edges.filter(last_shared_on__lt=shared_on)\
+             .update(last_shared_on=shared_on)
+        
+        existing = set(self.filter(user=user_id, friend__in=friend_ids)\
+                           .values_list('friend', flat=True))
+        for friend_id in friend_ids:
+            if friend_id in existing:
+                continue
+            for edge in [(user_id, friend_id), (friend_id, user_id)]:
+                try:
+                    with transaction.atomic():
+                        self.create(user_id=edge[0], friend_id=edge[1],
+                                    shared_present_count=1,
+                                    last_shared_on=shared_on)
+                except IntegrityError: # created concurrently
+                    self._add_edges(edge[0], [edge[1]], shared_on)
+    
+    def _remove_edges(self, user_id, friend_ids, present_id):
+        """Decrement the friendships between the given user and each given
+        friend (in both directions) which came from the given present,
+        deleting the ones that reach zero.
+        
+        """
+        if not friend_ids:
+            return
+        decrement = {
+            'shared_present_count': F('shared_present_count') - 1,
+        }
+        self.filter(user=user_id, friend__in=friend_ids,
+                    shared_present_count__gt=0).update(**decrement)
+        self.filter(user__in=friend_ids, friend=user_id,
+                    shared_present_count__gt=0).update(**decrement)
+        self.filter(models.Q(user=user_id) | models.Q(friend=user_id),
+                    shared_present_count=0).delete()
+        self._update_last_shared_on(user_id, friend_ids, present_id)
+    
+    def _update_last_shared_on(self, user_id, friend_ids, present_id):
+        """Recompute the last_shared_on of the friendships between the given
+        user and the given friends, without the given present (which is being
+        removed), like rebuild() does.
+        
+        """
+        rows = Participant.objects.filter(
+            user=user_id, present__participants__user__in=friend_ids)\
+            .exclude(present=present_id)\
+            .values_list('present__participants__user')\
+            .annotate(last_shared_on=Max('present__created_on'))
+        for friend_id, last_shared_on in rows:
+            self._edges(user_id, [friend_id])\
+                .update(last_shared_on=last_shared_on)
+
+
+class Friendship(models.Model):
+    """A denormalized edge of the friendship graph: two users are friends if
+    they participate in at least one common present.
+    Each friendship is stored twice, once in each direction.
+    
+    """
+    user = models.ForeignKey('auth.User', verbose_name=_("user"),
+                             related_name='friendships')
+    friend = models.ForeignKey('auth.User', verbose_name=_("friend"),
+                               related_name='friend_of')
+    shared_present_count = models.PositiveIntegerField(_("shared presents"),
+                                                       default=0)
+    last_shared_on = models.DateTimeField(_("last shared on"),
+                                          default=timezone.now)
+    
+    objects = FriendshipManager()
+    
+    class Meta:
+        verbose_name = _("friendship")
+        verbose_name_plural = _("friendships")
+        unique_together = ('user', 'friend')
+    
+    def __unicode__(self):
+        return u"%s -> %s" % (self.user, self.friend)
+
+
+
+class GifteeEntryManager(models.Manager):
+    def search(self, user, prefix, limit):
+        """Return the names of the given user's giftees that start with the
+        given prefix (ignoring case and accents), most used first.
+        
+        """
+        key = normalize_giftee(prefix)
+        qs = self.filter(user=user)
+        if key:
+            # A range lookup can use the (user, key) index, unlike LIKE.
+            qs = qs.filter(key__gte=key, key__lt=key + u'\uffff')
+        qs = qs.order_by('-present_count', 'key')
+        return qs.values_list('name', flat=True)[:limit]
+    
+    def add(self, user_ids, giftee, delta=1):
+        """Add `delta` presents for the given giftee to the entries of all the
+        given users, creating or deleting entries as needed.
+        
+        """
+        key = normalize_giftee(giftee)
+        if not user_ids or not key:
+            return
+        entries = self.filter(user__in=user_ids, key=key)
+        entries.update(present_count=F('present_count') + delta)
+        if delta < 0:
+            entries.filter(present_count__lte=0).delete()
+            return
+        
+        existing = set(entries.values_list('user', flat=True))
+        for user_id in user_ids:
+            if user_id in existing:
+                continue
+            try:
+                with transaction.atomic():
+                    self.create(user_id=user_id, key=key, name=giftee,
+                                present_count=delta)
+            except IntegrityError: # created concurrently
+                self.filter(user=user_id, key=key)\
+                    .update(present_count=F('present_count') + delta)
+    
+    def rebuild(self):
+        """Delete all entries and re-create them from the participants table.
+        Return the number of entries created.
+        
+        """
+        entries = {}
+        rows = Participant.objects.order_by('present__created_on', 'present')\
+                                  .values_list('user', 'present__giftee')
+        for user_id, giftee in rows.iterator():
+            key = normalize_giftee(giftee)
+            if not key:
+                continue
+            # Keep the first spelling of the name, like add() does.
+            name, count = entries.get((user_id, key), (giftee, 0))
+            entries[user_id, key] = (name, count + 1)
+        
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create([
+                self.model(user_id=user_id, key=key, name=name,
+                           present_count=count)
+                for (user_id, key), (name, count) in entries.iteritems()
+            ], batch_size=500)
+        return len(entries)
+
+
+class GifteeEntry(models.Model):
+    """The number of presents for a given giftee that a user participates in.
+    This is what the giftee autocompletion searches.
+    
+    """
+    user = models.ForeignKey('auth.User', verbose_name=_("user"),
+                             related_name='giftee_entries')
+    key = models.CharField(_("key"), max_length=100)
+    name = models.CharField(_("giftee"), max_length=100)
+    present_count = models.PositiveIntegerField(_("number of presents"),
+                                                default=0)
+    
+    objects = GifteeEntryManager()
+    
+    class Meta:
+        verbose_name = _("giftee entry")
+        verbose_name_plural = _("giftee entries")
+        unique_together = ('user', 'key')
+    
+    def __unicode__(self):
+        return self.name
+
+
+
+class ActivityEventManager(models.Manager):
+    def for_user(self, user):
+        """Return the given user's events (newest first) with their present
+        and comment, skipping archived presents.
+        
+        """
+        qs = self.filter(user=user)
+        qs = qs.exclude(present__status=Present.STATUS.ARCHIVED)
+        qs = qs.select_related('present', 'comment__author')
+        return qs.order_by('-created_on', '-pk')
+    
+    def participants_added(self, present, user_ids):
+        """Give the users who have just been added to the present the events
+        of that present (its creation and its comments).
+        
+        """
+        comments = present.comment_set.values_list('pk', 'posted_on')
+        events = [(None, present.created_on)] + list(comments)
+        self.bulk_create([
+            self.model(user_id=user_id, present_id=present.pk,
+                       comment_id=comment_id, created_on=created_on)
+            for user_id in user_ids
+            for comment_id, created_on in events
+        ], batch_size=500)
+    
+    def participant_removed(self, present_id, user_id):
+        self.filter(present=present_id, user=user_id).delete()
+    
+    def comment_posted(self, comment):
+        """Add an event for the comment to the feed of all the participants
+        of its present.
+        
+        """
+        user_ids = Participant.objects.filter(present=comment.present_id)\
+                                      .values_list('user', flat=True)
+        self.bulk_create([
+            self.model(user_id=user_id, present_id=comment.present_id,
+                       comment_id=comment.pk, created_on=comment.posted_on)
+            for user_id in user_ids
+        ], batch_size=500)
+    
+    def rebuild(self):
+        """Delete all events and re-create them from the participants and
+        comments tables. Return the number of events created.
+        
+        """
+        rows = Participant.objects.values_list('user', 'present',
+                                               'present__created_on')
+        events = [self.model(user_id=user_id, present_id=present_id,
+                             created_on=created_on)
+                  for user_id, present_id, created_on in rows.iterator()]
+        rows = Comment.objects.values_list('present__participants__user',
+                                           'present', 'pk', 'posted_on')
+        events.extend(self.model(user_id=user_id, present_id=present_id,
+                                 comment_id=comment_id, created_on=created_on)
+                      for user_id, present_id, comment_id, created_on
+                      in rows.iterator())
+        
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(events, batch_size=500)
+        return len(events)
+
+
+class ActivityEvent(models.Model):
+    """An entry of a user's activity feed, shown on the landing page: either
+    a present the user participates in (when `comment` is None) or a comment
+    posted on one.
+    
+    The events are written for every participant when the present is shared
+    with them or when the comment is posted, so reading a feed is a single
+    query.
+    
+    """
+    user = models.ForeignKey('auth.User', verbose_name=_("user"),
+                             related_name='activity_events')
+    present = models.ForeignKey(Present, verbose_name=_("present"))
+    comment = models.ForeignKey(Comment, verbose_name=_("comment"),
+                                blank=True, null=True)
+    created_on = models.DateTimeField(_("created on"))
+    
+    objects = ActivityEventManager()
+    
+    class Meta:
+        verbose_name = _("activity event")
+        verbose_name_plural = _("activity events")
+        index_together = [('user', 'created_on')]
+    
+    def __unicode__(self):
+        return unicode(self.comment or self.present)
+
+
+class SearchTermManager(models.Manager):
+    # Weight of a word depending on where it appears
+    WEIGHTS = {
+        'title': 10,
+        'description': 3,
+        'link': 2,
+        'comment': 1,
+    }
+    
+    def _terms(self, present_id, comment_id, fields):
+        """Return the (unsaved) terms for the given (field name, text) pairs,
+        one per distinct word, weighted by where and how often it appears.
+        
+        """
+        weights = defaultdict(int)
+        for name, text in fields:
+            for word in tokenize(text):
+                weights[word] += self.WEIGHTS[name]
+        return [self.model(term=term, present_id=present_id,
+                           comment_id=comment_id, weight=weight)
+                for term, weight in weights.iteritems()]
+    
+    def _present_terms(self, present):
+        return self._terms(present.pk, None, [
+            ('title', present.title),
+            ('description', present.description),
+            ('link', present.link),
+        ])
+    
+    def index_present(self, present):
+        """Replace the terms of the given present's title, description and
+        link (but not its comments).
+        
+        """
+        self.filter(present=present, comment=None).delete()
+        self.bulk_create(self._present_terms(present))
+    
+    def index_new_presents(self, presents):
+        """Add the terms of the given presents, which have no terms yet."""
+        terms = []
+        for present in presents:
+            terms.extend(self._present_terms(present))
+        self.bulk_create(terms, batch_size=500)
+    
+    def index_comment(self, comment):
+        """Replace the terms of the given comment."""
+        self.filter(comment=comment).delete()
+        self.bulk_create(self._terms(comment.present_id, comment.pk, [
+            ('comment', comment.text),
+        ]))
+    
+    def search(self, user, query, limit=50):
+        """Return the presents in which the given user participates and that
+        match all the words of the query (as prefixes), best matches first.
+        
+        Each present is annotated with its `score`, the normalized `terms` of
+        the query and the `matching_comment` that matches best, if any.
+        
+        """
+        terms = sorted(set(tokenize(query)))[:10]
+        if not terms:
+            return []
+        
+        scores = None
+        for term in terms:
+            # A range lookup can use the term index, unlike LIKE.
+            rows = self.filter(term__gte=term, term__lt=term + u'\uffff',
+                               present__participants__user=user)\
+                       .values_list('present').annotate(Sum('weight'))
+            rows = dict(rows)
+            if scores is None:
+                scores = rows
+            else:
+                scores = dict((pk, score + rows[pk])
+                              for pk, score in scores.iteritems()
+                              if pk in rows)
+            if not scores:
+                return []
+        
+        best = sorted(scores, key=lambda pk: (-scores[pk], -pk))[:limit]
+        presents = Present.objects.in_bulk(best)
+        
+        comments = {}
+        for term in terms:
+            rows = self.filter(term__gte=term, term__lt=term + u'\uffff',
+                               present__in=best, comment__isnull=False)
+            for present_id, comment_id, weight in rows.values_list(
+                    'present', 'comment', 'weight'):
+                if weight > comments.get(present_id, (None, 0))[1]:
+                    comments[present_id] = (comment_id, weight)
+        comment_objects = Comment.objects.select_related('author')\
+                                 .in_bulk([c for c, w in comments.values()])
+        
+        results = []
+        for pk in best:
+            present = presents[pk]
+            present.score = scores[pk]
+            present.terms = terms
+            comment_id = comments.get(pk, (None, 0))[0]
+            present.matching_comment = comment_objects.get(comment_id)
+            results.append(present)
+        return results
+    
+    def rebuild(self):
+        """Delete all the terms and re-index all presents and comments.
+        Return the number of terms created.
+        
+        """
+        terms = []
+        for pk, title, description, link in Present.objects.values_list(
+                'pk', 'title', 'description', 'link').iterator():
+            terms.extend(self._terms(pk, None, [('title', title),
+                                                ('description', description),
+                                                ('link', link)]))
+        for pk, present_id, text in Comment.objects.values_list(
+                'pk', 'present', 'text').iterator():
+            terms.extend(self._terms(present_id, pk, [('comment', text)]))
+        
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create(terms, batch_size=500)
+        return len(terms)
+
+
+class SearchTerm(models.Model):
+    """A normalized word of a present's title, description or link, or of
+    one of its comments (see noyel.kdo.utils.tokenize).
+    This is the inverted index behind the present search.
+    
+    """
+    term = models.CharField(_("term"), max_length=50)
+    present = models.ForeignKey(Present, verbose_name=_("present"))
+    comment = models.ForeignKey(Comment, verbose_name=_("comment"),
+                                blank=True, null=True)
+    weight = models.PositiveIntegerField(_("weight"))
+    
+    objects = SearchTermManager()
+    
+    class Meta:
+        verbose_name = _("search term")
+        verbose_name_plural = _("search terms")
+        index_together = [('term', 'present')]
+    
+    def __unicode__(self):
+        return self.term
+
+
+class OutboundEmailManager(models.Manager):
+    def queue(self, message):
+        """Store the given EmailMessage in the outbox. It will be sent later
+        by the send_outbox management command.
+        
+        """
+        return self.create(
+            subject=message.subject,
+            body=message.body,
+            from_email=message.from_email,
+            to=u'\n'.join(message.to),
+            cc=u'\n'.join(message.cc),
+            bcc=u'\n'.join(message.bcc),
+            headers=json.dumps(message.extra_headers),
+        )
+    
+    def due(self):
+        """Return the emails that should be sent now, oldest first."""
+        return self.filter(sent_on__isnull=True,
+                           next_attempt_on__lte=timezone.now())\
+                   .order_by('next_attempt_on', 'pk')
+    
+    def send_due(self, batch_size=100):
+        """Send at most `batch_size` due emails over a single connection.
+        Return a (sent, failed) tuple of counts.
+        
+        """
+        emails = list(self.due()[:batch_size])
+        if not emails:
+            return 0, 0
+        
+        sent, failed = [], 0
+        connection = get_connection()
+        try:
+            for index, email in enumerate(emails):
+                try:
+                    # Does nothing if the connection is already open
+                    connection.open()
+                except Exception as e:
+                    # The server can't be reached: retry the whole batch later
+                    for unsent in emails[index:]:
+                        unsent.retry_later(e)
+                    failed += len(emails) - index
+                    break
+                try:
+                    connection.send_messages([email.get_message(connection)])
+                except Exception as e:
+                    email.retry_later(e)
+                    failed += 1
+                    # The connection might be broken: start a new one.
+                    self._close(connection)
+                else:
+                    sent.append(email.pk)
+        finally:
+            self._close(connection)
+            self.filter(pk__in=sent).update(sent_on=timezone.now())
+        return len(sent), failed
+    
+    def _close(self, connection):
+        """Close the given connection, ignoring errors (it's likely to be
+        broken already).
+        
+        """
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+class OutboundEmail(models.Model):
+    """An email waiting in the outbox to be sent by the send_outbox command.
+    Failed emails are retried with an exponential backoff until MAX_ATTEMPTS
+    is reached, at which point next_attempt_on is cleared.
+    
+    """
+    MAX_ATTEMPTS = 8
+    RETRY_DELAY = timedelta(minutes=1)
+    
+    subject = models.TextField(_("subject"))
+    body = models.TextField(_("body"))
+    from_email = models.CharField(_("from"), max_length=254)
+    to = models.TextField(_("to"))
+    cc = models.TextField(_("cc"), blank=True)
+    bcc = models.TextField(_("bcc"), blank=True)
+    headers = models.TextField(_("headers"), default='{}')
+    
+    created_on = models.DateTimeField(_("created on"), auto_now_add=True)
+    next_attempt_on = models.DateTimeField(_("next attempt on"), null=True,
+                                           blank=True, default=timezone.now)
+    sent_on = models.DateTimeField(_("sent on"), null=True, blank=True)
+    attempts = models.PositiveIntegerField(_("failed attempts"), default=0)
+    last_error = models.TextField(_("last error"), blank=True)
+    
+    objects = OutboundEmailManager()
+    
+    class Meta:
+        verbose_name = _("outbound email")
+        verbose_name_plural = _("outbound emails")
+        index_together = [('sent_on', 'next_attempt_on')]
+    
+    def __unicode__(self):
+        return self.subject
+    
+    def get_message(self, connection=None):
+        """Return the EmailMessage corresponding to this email."""
+        split = lambda addresses: [a for a in addresses.split(u'\n') if a]
+        return EmailMessage(subject=self.subject, body=self.body,
+                            from_email=self.from_email,
+                            to=split(self.to), cc=split(self.cc),
+                            bcc=split(self.bcc),
+                            headers=json.loads(self.headers),
+                            connection=connection)
+    
+    def retry_later(self, error):
+        """Record a failed attempt and schedule the next one, doubling the
+        delay each time.
+        
+        """
+        self.attempts += 1
+        self.last_error = u'%r' % error
+        if self.attempts < self.MAX_ATTEMPTS:
+            delay = self.RETRY_DELAY * 2 ** (self.attempts - 1)
+            self.next_attempt_on = timezone.now() + delay
+        else:
+            self.next_attempt_on = None
+        self.save()
+
+
+# Connect the receivers that maintain cached and denormalized data.
+from noyel.kdo import signals
@@ -0,0 +1,209 @@
+"""Signal receivers that keep the cached and denormalized data of the kdo
+application up to date.
+
+This module is imported at the bottom of `noyel.kdo.models` so that the
+receivers are connected as soon as the models are loaded.
+
+Bulk operations (like QuerySet.update or bulk_create) don't send signals:
+code using them must call the `*_added` and `*_changed` functions below
+itself.
+
+"""
+from django.db.models.signals import (pre_save, post_save, pre_delete,
+                                      post_delete)
+from django.contrib.auth.models import User
+from django.dispatch import receiver
+
+from noyel.account.models import EmailAddress
+from noyel.kdo.cache import (invalidate_invitation_count,
+                             invalidate_data_version, invalidate_present_ids)
+from noyel.kdo.utils import normalize_giftee
+from noyel.kdo.models import (Present, Comment, Invitation, Participant,
+                               Friendship, GifteeEntry, ActivityEvent,
+                               SearchTerm)
+
+
+def invitations_changed(emails):
+    """Clear the invitation count of the users owning the given addresses."""
+    user_pks = EmailAddress.objects.filter(email__in=emails, verified=True)\
+                                   .values_list('user', flat=True)
+    user_data_changed(user_pks)
+
+
+def user_data_changed(user_pks):
+    """Clear the invitation count and change the data version of the given
+    users.
+    
+    """
+    invalidate_invitation_count(user_pks)
+    invalidate_data_version(user_pks)
+
+
+def present_changed(present_id, user_ids=()):
+    """Invalidate the cached template fragments of the given present and
+    change the data version of its participants (and of the given users).
+    
+    """
+    Present.increment_counter(present_id, 'render_version')
+    participants = Participant.objects.filter(present=present_id)\
+                                      .values_list('user', flat=True)
+    invalidate_data_version(list(participants) + list(user_ids))
+
+
+def participants_added(present, user_ids):
+    """Update the present's participant count and the new participants'
+    present ids, add them to the friends of the present's other participants
+    and to their giftee entries, and add the present's events to their
+    activity feed.
+    
+    """
+    Present.increment_counter(present.pk, 'participant_count', len(user_ids))
+    invalidate_present_ids(user_ids)
+    present_changed(present.pk)
+    Friendship.objects.participants_added(present, user_ids)
+    GifteeEntry.objects.add(user_ids, present.giftee)
+    ActivityEvent.objects.participants_added(present, user_ids)
+
+
+def presents_created(user, presents):
+    """Add the given presents, which were just created with the given user as
+    their only participant, to the user's giftee entries and activity feed.
+    Their search terms were added when they were saved.
+    
+    The presents' participant_count must already be set.
+    
+    """
+    giftees = {}
+    for present in presents:
+        key = normalize_giftee(present.giftee)
+        name, count = giftees.get(key, (present.giftee, 0))
+        giftees[key] = (name, count + 1)
+    for name, count in giftees.itervalues():
+        GifteeEntry.objects.add([user.pk], name, count)
+    ActivityEvent.objects.bulk_create([
+        ActivityEvent(user=user, present_id=present.pk,
+                      created_on=present.created_on)
+        for present in presents
+    ], batch_size=500)
+    invalidate_present_ids([user.pk])
+    invalidate_data_version([user.pk])
+
+
+@receiver(post_save, sender=Invitation)
+@receiver(post_delete, sender=Invitation)
+def invitation_changed(sender, instance, **kwargs):
+    """Clear the invitation count of the users owning the invited address.
+    This covers creation, deletion and redemption (which deletes the
+    invitation).
+    
+    """
+    invitations_changed([instance.sent_to])
+    present_changed(instance.present_id)
+
+
+@receiver(post_save, sender=EmailAddress)
+@receiver(post_delete, sender=EmailAddress)
+def email_address_changed(sender, instance, **kwargs):
+    """Clear the invitation count of the address' owner: verifying or deleting
+    an address changes which invitations they can see.
+    
+    """
+    user_data_changed([instance.user_id])
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, **kwargs):
+    """Change the data version of the user and their friends, whose pages
+    show the user's name.
+    
+    """
+    friends = Friendship.objects.filter(user=instance.pk)\
+                                .values_list('friend', flat=True)
+    invalidate_data_version([instance.pk] + list(friends))
+
+
+@receiver(post_save, sender=Participant)
+def participant_created(sender, instance, created, **kwargs):
+    if created:
+        participants_added(instance.present, [instance.user_id])
+
+
+@receiver(pre_delete, sender=Participant)
+def participant_deleting(sender, instance, **kwargs):
+    """Remove the participant's present from their giftee entries."""
+    GifteeEntry.objects.add([instance.user_id], instance.present.giftee, -1)
+
+
+@receiver(post_delete, sender=Participant)
+def participant_deleted(sender, instance, **kwargs):
+    """Update the present's participant count and the user's present ids,
+    and remove the friendships and the activity events that came from the
+    deleted participation.
+    When a whole present is deleted, its participants are all gone by the time
+    this runs so nothing happens here (see present_deleted).
+    
+    """
+    Present.increment_counter(instance.present_id, 'participant_count', -1)
+    invalidate_present_ids([instance.user_id])
+    present_changed(instance.present_id, [instance.user_id])
+    Friendship.objects.participant_removed(instance.present_id,
+                                           instance.user_id)
+    ActivityEvent.objects.participant_removed(instance.present_id,
+                                              instance.user_id)
+
+
+@receiver(pre_delete, sender=Present)
+def present_deleted(sender, instance, **kwargs):
+    """Remove the friendships that came from the present being deleted and
+    change the data version of its participants.
+    
+    """
+    Friendship.objects.present_removed(instance.pk)
+    present_changed(instance.pk)
+
+
+@receiver(pre_save, sender=Present)
+def present_saving(sender, instance, **kwargs):
+    """Remember the giftee stored in the database before a present is saved so
+    that present_saved can tell if it changed.
+    
+    """
+    instance._old_giftee = None
+    if instance.pk is not None:
+        old = Present.objects.filter(pk=instance.pk)\
+                             .values_list('giftee', flat=True)
+        instance._old_giftee = next(iter(old), None)
+
+
+@receiver(post_save, sender=Present)
+def present_saved(sender, instance, created, **kwargs):
+    """Invalidate the present's cached data, update its search terms and move
+    its participants' giftee entries to the new giftee.
+    
+    """
+    if created:
+        SearchTerm.objects.index_new_presents([instance])
+    else:
+        present_changed(instance.pk)
+        SearchTerm.objects.index_present(instance)
+    old, new = instance._old_giftee, instance.giftee
+    if old is None or normalize_giftee(old) == normalize_giftee(new):
+        return
+    user_ids = list(instance.participants.values_list('user', flat=True))
+    GifteeEntry.objects.add(user_ids, old, -1)
+    GifteeEntry.objects.add(user_ids, new)
+
+
+@receiver(post_save, sender=Comment)
+def comment_saved(sender, instance, created, **kwargs):
+    if created:
+        Present.increment_counter(instance.present_id, 'comment_count')
+        ActivityEvent.objects.comment_posted(instance)
+    present_changed(instance.present_id)
+    SearchTerm.objects.index_comment(instance)
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    Present.increment_counter(instance.present_id, 'comment_count', -1)
+    present_changed(instance.present_id)
@@ -0,0 +1,5 @@
+-- The status and last change of the presents, for the lists of the presents
+-- that aren't archived and for the archival of old purchases. The archived
+-- presents are never listed, so they are left out of the index.
+CREATE INDEX "kdo_present_active_status_updated_on"
+    ON "kdo_present" ("status", "updated_on") WHERE "status" <> 10;
@@ -0,0 +1,9 @@
+-- The status and last change of the presents, for the lists of the presents
+-- that aren't archived and for the archival of old purchases.
+--
+-- PostgreSQL gets a partial index without the archived presents (see
+-- present.postgresql_psycopg2.sql) but SQLite can only use a partial index
+-- when its condition appears in the query with literal values, and Django
+-- passes them as parameters.
+CREATE INDEX "kdo_present_status_updated_on"
+    ON "kdo_present" ("status", "updated_on");
@@ -34,9 +34,10 @@ def purchase_form(present, user):
 def invitation_count(user):
     """Return the number of invitations the given user has (including expired
     ones).
+    The count is cached so that rendering the navbar doesn't hit the database.
     
     """
-    return Invitation.objects.for_user(user).count()
+    return Invitation.objects.count_for_user(user)
 
 @register.filter
 def netloc(url):
@@ -5,7 +5,43 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import base64
+import json
+import os
+import re
+import shutil
+import tempfile
+from datetime import timedelta
+from StringIO import StringIO
+from unittest import skipUnless
+
+from django.contrib import messages
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.http import Http404
+from django.db import connection, connections, DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone, translation
+
+from noyel.kdo import emails, export, importer, transitions
+from noyel.kdo.cache import check_cache_backend, present_ids_key
+from noyel.kdo.forms import (EditConflict, PresentPurchaseForm,
+                             PresentInvitationForm)
+from noyel.kdo.middleware import (QueryBudgetExceeded, QueryTimer,
+                                 list_profiles, make_profiling_token)
+from noyel.kdo.mixins import get_present_or_404
+from noyel.kdo.models import (Present, Comment, Invitation, Participant,
+                              OutboundEmail, ActivityEvent, SearchTerm,
+                              GifteeEntry, Friendship)
 
 
 class SimpleTest(TestCase):
@@ -14,3 +50,962 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class PresentDetailQueriesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', password='alice')
+        self.present = Present.objects.create(title="Lego", giftee="Zoe")
+        self.present.participants.create(user=self.user)
+        self.present.comment_set.create(author=self.user, text="First!")
+        self.url = reverse('kdo-present-detail', args=[self.present.pk])
+        self.client.login(username='alice', password='alice')
+        # Fill the cache of the navbar's invitation count.
+        self.client.get(self.url)
+    
+    def add_participant_and_comment(self, i):
+        user = User.objects.create_user('user%d' % i)
+        self.present.participants.create(user=user)
+        self.present.comment_set.create(author=user, text="Comment %d" % i)
+        Invitation.objects.create(present=self.present, sent_by=user,
+                                  sent_to='user%d@example.com' % i)
+    
+    def test_constant_number_of_queries(self):
+        with self.assertNumQueries(9):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        
+        for i in range(10):
+            self.add_participant_and_comment(i)
+        
+        with self.assertNumQueries(9):
+            response = self.client.get(self.url)
+        self.assertContains(response, "Comment 9")
+        self.assertContains(response, "user9@example.com")
+
+
+class PresentAccessTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='alice')
+        self.bob = User.objects.create_user('bob', password='bob')
+        self.present = Present.objects.create(title="Lego", giftee="Zoe")
+        self.present.participants.create(user=self.alice)
+        self.url = reverse('kdo-present-detail', args=[self.present.pk])
+    
+    def test_present_ids_are_cached(self):
+        with self.assertNumQueries(2):
+            Participant.objects.present_ids(self.alice)
+            Participant.objects.present_ids(self.bob)
+        with self.assertNumQueries(0):
+            self.assertRaises(Http404, get_present_or_404, self.bob,
+                              self.present.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_present_or_404(self.alice, self.present.pk),
+                             self.present)
+    
+    def test_present_checked_before_loading(self):
+        self.client.login(username='bob', password='bob')
+        Participant.objects.present_ids(self.bob)
+        # session, user and the invitation count of the 404 page
+        with self.assertNumQueries(3):
+            self.assertEqual(self.client.get(self.url).status_code, 404)
+    
+    def test_participants_changes(self):
+        self.client.login(username='bob', password='bob')
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        
+        participant = self.present.participants.create(user=self.bob)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        
+        participant.delete()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+    
+    def test_removed_participant_cached_before_commit(self):
+        self.present.participants.create(user=self.bob)
+        
+        def stale_read(sender, instance, **kwargs):
+            # Another request reading the present ids before the removal is
+            # committed (the receivers run inside the delete transaction).
+            cache.set(present_ids_key(self.bob.pk),
+                      frozenset([self.present.pk]))
+        post_delete.connect(stale_read, sender=Participant)
+        try:
+            self.client.login(username='alice', password='alice')
+            self.client.post(reverse('kdo-present-remove-participant',
+                                     args=[self.present.pk, self.bob.pk]))
+        finally:
+            post_delete.disconnect(stale_read, sender=Participant)
+        
+        self.client.login(username='bob', password='bob')
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+    
+    def test_invitation_views(self):
+        invitation = Invitation.objects.create(present=self.present,
+                                               sent_by=self.alice,
+                                               sent_to='bob@example.com')
+        url = reverse('kdo-invitation-delete', args=[invitation.token])
+        self.client.login(username='bob', password='bob')
+        self.assertEqual(self.client.post(url).status_code, 404)
+        self.client.login(username='alice', password='alice')
+        self.assertEqual(self.client.post(url).status_code, 302)
+        self.assertFalse(Invitation.objects.exists())
+
+
+class EditConflictTest(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='alice')
+        self.bob = User.objects.create_user('bob', password='bob')
+        self.present = Present.objects.create(title="Lego", giftee="Zoe")
+        self.present.participants.create(user=self.alice)
+        self.present.participants.create(user=self.bob)
+        self.version = self.present.version
+    
+    def test_concurrent_purchases(self):
+        data = {'price': '12', 'version': self.version}
+        # Both forms are validated before either of them is saved.
+        forms = []
+        for user in [self.alice, self.bob]:
+            present = Present.objects.get(pk=self.present.pk)
+            forms.append(PresentPurchaseForm(data, user=user,
+                                             instance=present))
+        self.assertTrue(all(form.is_valid() for form in forms))
+        forms[0].save()
+        self.assertRaises(EditConflict, forms[1].save)
+        present = Present.objects.get(pk=self.present.pk)
+        self.assertEqual(present.bought_by, self.alice)
+        self.assertEqual(present.version, self.version + 1)
+        
+        # Once the purchase is visible, the form refuses it.
+        url = reverse('kdo-present-purchase', args=[self.present.pk])
+        self.client.login(username='bob', password='bob')
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].non_field_errors())
+    
+    def test_concurrent_edits(self):
+        url = reverse('kdo-present-update', args=[self.present.pk])
+        data = {'title': "Duplo", 'giftee': "Zoe", 'version': self.version}
+        self.client.login(username='alice', password='alice')
+        # Following the redirection displays the success message.
+        response = self.client.post(url, data, follow=True)
+        self.assertEqual(response.redirect_chain[0][1], 302)
+        
+        data['title'] = "Kite"
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 200)
+        form = response.context['form']
+        self.assertTrue(form.non_field_errors())
+        self.assertEqual(form['version'].value(), self.version + 1)
+        levels = [m.level for m in response.context['messages']]
+        self.assertIn(messages.ERROR, levels)
+        self.assertNotIn(messages.SUCCESS, levels)
+        self.assertEqual(Present.objects.get(pk=self.present.pk).title,
+                         "Duplo")
+        
+        # Submitting again knowingly overwrites the other change.
+        data['version'] = form['version'].value()
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertEqual(SearchTerm.objects.search(self.alice, "kite"),
+                         [self.present])
+
+
+class FriendshipTest(TestCase):
+    def setUp(self):
+        self.a, self.b, self.c = [User.objects.create_user(name)
+                                  for name in ['a', 'b', 'c']]
+    
+    def create_present(self, days_ago, users):
+        present = Present.objects.create(title="Present", giftee="Zoe")
+        Present.objects.filter(pk=present.pk).update(
+            created_on=timezone.now() - timedelta(days=days_ago))
+        present = Present.objects.get(pk=present.pk)
+        for user in users:
+            present.participants.create(user=user)
+        return present
+    
+    def friendships(self):
+        return sorted(Friendship.objects.values_list(
+            'user__username', 'friend__username', 'shared_present_count',
+            'last_shared_on'))
+    
+    def assertSameAsRebuild(self):
+        friendships = self.friendships()
+        Friendship.objects.rebuild()
+        self.assertEqual(self.friendships(), friendships)
+        return friendships
+    
+    def test_incremental_updates_match_rebuild(self):
+        old = self.create_present(10, [self.a, self.b, self.c])
+        recent = self.create_present(1, [self.a, self.b])
+        friendships = self.assertSameAsRebuild()
+        self.assertEqual(friendships[0], ('a', 'b', 2, recent.created_on))
+        self.assertEqual(friendships[1], ('a', 'c', 1, old.created_on))
+        
+        # An older present doesn't change last_shared_on
+        oldest = self.create_present(20, [self.a, self.b])
+        friendships = self.assertSameAsRebuild()
+        self.assertEqual(friendships[0], ('a', 'b', 3, recent.created_on))
+        
+        recent.participants.get(user=self.b).delete()
+        friendships = self.assertSameAsRebuild()
+        self.assertEqual(friendships[0], ('a', 'b', 2, old.created_on))
+        
+        old.delete()
+        friendships = self.assertSameAsRebuild()
+        self.assertEqual(friendships, [
+            ('a', 'b', 1, oldest.created_on),
+            ('b', 'a', 1, oldest.created_on),
+        ])
+
+
+class GifteeIndexTest(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+    
+    def create_present(self, giftee, users):
+        present = Present.objects.create(title="Present", giftee=giftee)
+        for user in users:
+            present.participants.create(user=user)
+        return present
+    
+    def entries(self):
+        return sorted(GifteeEntry.objects.values_list(
+            'user__username', 'key', 'present_count'))
+    
+    def assertEntries(self, entries):
+        # Names aren't compared: rebuild() can only keep the first spelling
+        # among the remaining presents.
+        self.assertEqual(self.entries(), entries)
+        GifteeEntry.objects.rebuild()
+        self.assertEqual(self.entries(), entries)
+    
+    def test_counts(self):
+        first = self.create_present(u"Zo\xe9", [self.alice])
+        self.create_present(u"zoe", [self.alice])
+        self.assertEntries([('alice', 'zoe', 2)])
+        self.assertEqual(GifteeEntry.objects.get(user=self.alice).name,
+                         u"Zo\xe9")
+        
+        participant = first.participants.create(user=self.bob)
+        self.assertEntries([('alice', 'zoe', 2), ('bob', 'zoe', 1)])
+        
+        first.giftee = u"Tom"
+        first.save()
+        self.assertEntries([('alice', 'tom', 1),
+                            ('alice', 'zoe', 1),
+                            ('bob', 'tom', 1)])
+        
+        participant.delete()
+        self.assertEntries([('alice', 'tom', 1), ('alice', 'zoe', 1)])
+    
+    def test_search_by_count(self):
+        self.create_present(u"Zack", [self.alice])
+        for i in range(2):
+            self.create_present(u"Zo\xe9", [self.alice])
+        self.create_present(u"Bob", [self.alice])
+        self.assertEqual(list(GifteeEntry.objects.search(self.alice, u"Z", 8)),
+                         [u"Zo\xe9", u"Zack"])
+        self.assertEqual(list(GifteeEntry.objects.search(self.alice, u"", 1)),
+                         [u"Zo\xe9"])
+        self.assertEqual(list(GifteeEntry.objects.search(self.bob, u"Z", 8)),
+                         [])
+
+
+@override_settings(KDO_PRESENTS_PER_PAGE=2)
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='alice')
+        for i in range(5):
+            present = Present.objects.create(title="P%d" % i, giftee="Zoe")
+            present.participants.create(user=self.user)
+        # Presents changed at the same time are ordered by pk
+        Present.objects.exclude(title="P4").update(
+            updated_on=timezone.now() - timedelta(days=1))
+        self.url = reverse('kdo-present-list')
+        self.client.login(username='alice', password='alice')
+    
+    def get_page(self, query=''):
+        response = self.client.get(self.url + query)
+        titles = [p.title for p in response.context['object_list']]
+        return (titles, response.context['previous_page_url'],
+                response.context['next_page_url'])
+    
+    def test_next_and_previous_pages(self):
+        titles, previous_url, next_url = self.get_page()
+        self.assertEqual(titles, ["P4", "P3"])
+        self.assertIsNone(previous_url)
+        
+        titles, previous_url, next_url = self.get_page(next_url)
+        self.assertEqual(titles, ["P2", "P1"])
+        
+        titles, last_previous_url, next_url = self.get_page(next_url)
+        self.assertEqual(titles, ["P0"])
+        self.assertIsNone(next_url)
+        
+        titles, previous_url, next_url = self.get_page(last_previous_url)
+        self.assertEqual(titles, ["P2", "P1"])
+        titles, previous_url, next_url = self.get_page(previous_url)
+        self.assertEqual(titles, ["P4", "P3"])
+        self.assertIsNone(previous_url)
+        self.assertIsNotNone(next_url)
+    
+    def test_invalid_cursor(self):
+        for token in ['garbage', base64.urlsafe_b64encode('next|nope|1'),
+                      base64.urlsafe_b64encode('up|2013-12-01T10:00:00|1'),
+                      base64.urlsafe_b64encode('next|2013-12-01T10:00:00')]:
+            response = self.client.get(self.url, {'cursor': token})
+            self.assertEqual(response.status_code, 404, token)
+
+
+class PresentSaveTest(TestCase):
+    def test_stale_instance_keeps_counters(self):
+        user = User.objects.create_user('alice')
+        present = Present.objects.create(title="Lego", giftee="Zoe")
+        stale = Present.objects.get(pk=present.pk)
+        present.participants.create(user=user)
+        present.comment_set.create(author=user, text="First!")
+        render_version = Present.objects.get(pk=present.pk).render_version
+        
+        stale.title = "Duplo"
+        stale.save()
+        present = Present.objects.get(pk=present.pk)
+        self.assertEqual(present.title, "Duplo")
+        self.assertEqual(present.comment_count, 1)
+        self.assertEqual(present.participant_count, 1)
+        # Bumped by the save
+        self.assertEqual(present.render_version, render_version + 1)
+    
+    def test_stale_instance_increments_version(self):
+        present = Present.objects.create(title="Lego", giftee="Zoe")
+        stale = Present.objects.get(pk=present.pk)
+        version = present.version
+        present.save()
+        present.save()
+        self.assertEqual(present.version, version + 2)
+        
+        # A form built on the version seen by the stale instance must not
+        # match again once the stale instance is saved.
+        stale.save()
+        self.assertEqual(stale.version, version + 3)
+        self.assertEqual(Present.objects.get(pk=present.pk).version,
+                         version + 3)
+        present.title = "Duplo"
+        self.assertFalse(present.save_if_unchanged(version + 2, ['title']))
+        self.assertTrue(present.save_if_unchanged(version + 3, ['title']))
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', password='alice')
+        self.present = Present.objects.create(title="Lego", giftee="Zoe")
+        self.present.participants.create(user=self.user)
+        self.url = reverse('kdo-present-detail', args=[self.present.pk])
+        self.client.login(username='alice', password='alice')
+    
+    def test_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.assertNumQueries(2): # session and user
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        
+        self.present.comment_set.create(author=self.user, text="Hello")
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+    
+    def test_no_etag_with_pending_messages(self):
+        self.client.post(reverse('kdo-comment-create', args=[self.present.pk]),
+                         {'text': "Hello", 'next': self.url})
+        response = self.client.get(self.url)
+        self.assertTrue(list(response.context['messages']))
+        self.assertFalse(response.has_header('ETag'))
+    
+    def test_shared_cache_required(self):
+        # The tests use the default local-memory cache.
+        with self.settings(DEBUG=True):
+            check_cache_backend()
+        with self.settings(DEBUG=False):
+            self.assertRaises(ImproperlyConfigured, check_cache_backend)
+
+
+class DictionaryTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', password='alice')
+        self.bob = User.objects.create_user('bob')
+        present = Present.objects.create(title="Lego", giftee=u"Zo\xe9")
+        present.participants.create(user=self.user)
+        present.participants.create(user=self.bob)
+        self.url = reverse('kdo-dictionary')
+        self.client.login(username='alice', password='alice')
+    
+    def test_dictionary(self):
+        data = json.loads(self.client.get(self.url).content)
+        self.assertEqual(data['giftees'], [[u"Zo\xe9", u"zoe", 1]])
+        self.assertEqual(data['friends'], [u"bob"])
+        
+        response = self.client.get(self.url, {'since': data['version']})
+        self.assertEqual(json.loads(response.content),
+                         {'version': data['version'], 'unchanged': True})
+        
+        Present.objects.create(title="Duplo", giftee="Zack")\
+                       .participants.create(user=self.user)
+        response = self.client.get(self.url, {'since': data['version']})
+        self.assertEqual(len(json.loads(response.content)['giftees']), 2)
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='alice')
+        self.lego = Present.objects.create(title="Lego castle", giftee="Zoe",
+                                           description="The big one")
+        self.lego.participants.create(user=self.user)
+        self.duplo = Present.objects.create(title="Duplo", giftee="Zoe")
+        self.duplo.participants.create(user=self.user)
+        self.duplo.comment_set.create(author=self.user,
+                                      text="Better than a <b>Lego</b> set")
+        self.hidden = Present.objects.create(title="Lego train", giftee="Bob")
+        self.client.login(username='alice', password='alice')
+    
+    def test_ranking_and_access(self):
+        results = SearchTerm.objects.search(self.user, u"l\xe9go")
+        self.assertEqual(results, [self.lego, self.duplo])
+        self.assertEqual(results[1].matching_comment.text,
+                         "Better than a <b>Lego</b> set")
+        self.assertEqual(SearchTerm.objects.search(self.user, "lego big"),
+                         [self.lego])
+        self.assertEqual(SearchTerm.objects.search(self.user, "lego bob"), [])
+    
+    def test_index_is_maintained(self):
+        self.lego.title = "Playmobil"
+        self.lego.save()
+        self.duplo.comment_set.all().delete()
+        self.assertEqual(SearchTerm.objects.search(self.user, "lego"), [])
+        
+        count = SearchTerm.objects.count()
+        self.assertEqual(SearchTerm.objects.rebuild(), count)
+    
+    def test_highlighted_results(self):
+        response = self.client.get(reverse('kdo-search-present'), {'q': 'leg'})
+        results = json.loads(response.content)
+        self.assertEqual(results[0]['title'], "<mark>Lego</mark> castle")
+        self.assertEqual(results[1]['excerpt'],
+                         "Better than a &lt;b&gt;<mark>Lego</mark>&lt;/b&gt; set")
+        
+        response = self.client.get(reverse('kdo-present-search'), {'q': 'leg'})
+        self.assertContains(response, "<mark>Lego</mark> castle")
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='alice')
+        for i in range(5):
+            present = Present.objects.create(title="Present %d" % i,
+                                             giftee="Zoe" if i % 2 else "Bob")
+            present.participants.create(user=self.user)
+            present.comment_set.create(author=self.user, text=u"Comment \xe9")
+        Present.objects.create(title="Hidden", giftee="Zoe")
+        self.client.login(username='alice', password='alice')
+        self.url = reverse('kdo-present-export')
+    
+    def test_ndjson(self):
+        response = self.client.get(self.url, {'format': 'ndjson',
+                                              'giftee': 'zoe'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = ''.join(response.streaming_content).splitlines()
+        presents = [json.loads(line) for line in lines]
+        self.assertEqual([p['title'] for p in presents],
+                         ["Present 1", "Present 3"])
+        self.assertEqual(presents[0]['participants'], ["alice"])
+        self.assertEqual(presents[0]['comments'][0]['text'], u"Comment \xe9")
+    
+    def test_csv_in_chunks(self):
+        presents = export.get_presents(self.user)
+        with self.assertNumQueries(3 * 6): # 6 queries per chunk of 2
+            with translation.override('en'): # like management commands
+                lines = list(export.export(export.iter_presents(presents, 2),
+                                           'csv'))
+        self.assertEqual(len(lines), 6)
+        
+        out = StringIO()
+        call_command('export_presents', 'alice', format='csv', stdout=out)
+        self.assertEqual(out.getvalue(), ''.join(lines))
+
+
+class ImportTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='alice')
+        present = Present.objects.create(title="Lego", giftee="Zoe")
+        present.participants.create(user=self.user)
+        self.client.login(username='alice', password='alice')
+    
+    def test_import_presents(self):
+        rows = importer.parse("title,giftee,price,link\n"
+                              "Lego,zo\xc3\xa9,,\n"       # duplicate
+                              "Duplo,Zoe,12.5,\n"
+                              "Kite,Zoe,,not a link\n"  # invalid
+                              "Ball,Bob,,\n"
+                              "duplo,ZOE,,\n", 'csv')   # duplicate
+        with self.assertNumQueries(12 + 2 * 2): # 2 per created present
+            created, errors, skipped = importer.import_presents(self.user,
+                                                                rows)
+        self.assertEqual([p.title for p in created], ["Duplo", "Ball"])
+        self.assertEqual([number for number, e in errors], [3])
+        self.assertEqual(skipped, [1, 5])
+        
+        duplo = Present.objects.get(pk=created[0].pk)
+        self.assertEqual(duplo.title, "Duplo")
+        self.assertEqual(duplo.participant_count, 1)
+        self.assertEqual(duplo.participants.get().user, self.user)
+        self.assertEqual(GifteeEntry.objects.get(user=self.user,
+                                                 key='zoe').present_count, 2)
+        self.assertEqual(SearchTerm.objects.search(self.user, "ball"),
+                         [created[1]])
+        self.assertEqual(ActivityEvent.objects.filter(user=self.user).count(),
+                         3)
+    
+    def test_import_view(self):
+        data = '[{"title": "Duplo", "giftee": "Zoe"}, {"title": ""}]'
+        response = self.client.post(reverse('kdo-present-import'), {
+            'file': SimpleUploadedFile('presents.json', data),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['row_errors'][0][0], 2)
+        self.assertTrue(Present.objects.filter(title="Duplo"))
+
+
+class BulkStatusTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='alice')
+        self.presents = []
+        for i in range(3):
+            present = Present.objects.create(title="Present %d" % i,
+                                             giftee="Zoe" if i else "Bob")
+            present.participants.create(user=self.user)
+            self.presents.append(present)
+        self.hidden = Present.objects.create(title="Hidden", giftee="Zoe")
+        self.client.login(username='alice', password='alice')
+    
+    def statuses(self):
+        return list(Present.objects.order_by('pk')
+                                   .values_list('status', flat=True))
+    
+    def test_set_status(self):
+        presents = transitions.get_presents(self.user, giftee="zoe")
+        with self.assertNumQueries(2): # whatever the number of presents
+            count = transitions.set_status(presents,
+                                           Present.STATUS.ACCEPTED)
+        self.assertEqual(count, 2)
+        S = Present.STATUS
+        self.assertEqual(self.statuses(),
+                         [S.SUGGESTED, S.ACCEPTED, S.ACCEPTED, S.SUGGESTED])
+    
+    def test_bulk_status_view(self):
+        pks = [self.presents[0].pk, self.hidden.pk]
+        response = self.client.post(reverse('kdo-present-bulk-status'), {
+            'presents': pks,
+            'status': Present.STATUS.ARCHIVED,
+            'next': reverse('kdo-present-list'),
+        })
+        self.assertRedirects(response, reverse('kdo-present-list'))
+        S = Present.STATUS
+        self.assertEqual(self.statuses(),
+                         [S.ARCHIVED, S.SUGGESTED, S.SUGGESTED, S.SUGGESTED])
+    
+    def test_bulk_status_view_requires_a_selection(self):
+        response = self.client.post(reverse('kdo-present-bulk-status'), {
+            'status': Present.STATUS.ARCHIVED,
+        }, HTTP_REFERER=reverse('kdo-present-list'))
+        self.assertRedirects(response, reverse('kdo-present-list'))
+        self.assertNotIn(Present.STATUS.ARCHIVED, self.statuses())
+    
+    def test_archive_presents(self):
+        S = Present.STATUS
+        Present.objects.filter(pk__in=[self.presents[0].pk, self.hidden.pk])\
+                       .update(status=S.BOUGHT, updated_on=timezone.now() -
+                                                           timedelta(days=90))
+        Present.objects.filter(pk=self.presents[1].pk).update(status=S.BOUGHT)
+        
+        out = StringIO()
+        call_command('archive_presents', 'alice', older_than=30, stdout=out)
+        self.assertEqual(out.getvalue(), "Archived 1 presents.\n")
+        self.assertEqual(self.statuses(),
+                         [S.ARCHIVED, S.BOUGHT, S.SUGGESTED, S.BOUGHT])
+        
+        call_command('archive_presents', older_than=30, stdout=StringIO())
+        self.assertEqual(self.statuses(),
+                         [S.ARCHIVED, S.BOUGHT, S.SUGGESTED, S.ARCHIVED])
+    
+    def test_archive_presents_dry_run(self):
+        bob = User.objects.create_user('bob')
+        for present in self.presents[:2]:
+            present.participants.create(user=bob)
+        Present.objects.filter(pk__in=[p.pk for p in self.presents[:2]])\
+                       .update(status=Present.STATUS.BOUGHT)
+        
+        out = StringIO()
+        call_command('archive_presents', 'alice', 'bob', older_than=0,
+                     dry_run=True, stdout=out)
+        self.assertEqual(out.getvalue(), "2 presents would be archived.\n")
+        out = StringIO()
+        call_command('archive_presents', 'alice', 'bob', older_than=0,
+                     stdout=out)
+        self.assertEqual(out.getvalue(), "Archived 2 presents.\n")
+    
+    def test_buyer_cleared(self):
+        S = Present.STATUS
+        Present.objects.filter(pk__in=[p.pk for p in self.presents])\
+                       .update(status=S.BOUGHT, bought_by=self.user)
+        transitions.set_status(Present.objects.filter(pk=self.presents[0].pk),
+                               S.ARCHIVED)
+        transitions.set_status(Present.objects.filter(pk=self.presents[1].pk),
+                               S.SUGGESTED)
+        buyers = Present.objects.filter(pk__in=[p.pk for p in self.presents])\
+                                .order_by('pk')\
+                                .values_list('bought_by', flat=True)
+        self.assertEqual(list(buyers), [self.user.pk, None, self.user.pk])
+
+
+@skipUnless(connection.vendor == 'sqlite', "Uses EXPLAIN QUERY PLAN")
+class QueryPlanTest(TestCase):
+    """Check that the frequent queries are answered with indexes, without
+    reading a whole table.
+    
+    """
+    # "SCAN TABLE x" before SQLite 3.36, "SCAN x" after, without "USING ..."
+    # when no index is used.
+    FULL_SCAN = re.compile(r'^SCAN (TABLE )?\S+$')
+    
+    def setUp(self):
+        self.user = User.objects.create_user('alice')
+        self.present = Present.objects.create(title="Lego", giftee="Zoe")
+        self.present.participants.create(user=self.user)
+    
+    def assertNoFullScan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+        for row in cursor.fetchall():
+            if self.FULL_SCAN.match(row[-1]):
+                self.fail("%s in the plan of %s" % (row[-1], sql))
+    
+    def test_present_list(self):
+        presents = Present.objects.filter(participants__user=self.user)\
+                                  .exclude(status=Present.STATUS.ARCHIVED)
+        self.assertNoFullScan(presents.order_by('-updated_on', '-pk')[:51])
+        self.assertNoFullScan(presents.filter(giftee_key='zoe'))
+    
+    def test_comments(self):
+        self.assertNoFullScan(Comment.objects.filter(present=self.present))
+        self.assertNoFullScan(Comment.objects.filter(
+            present__in=[self.present.pk]))
+    
+    def test_invitations(self):
+        self.assertNoFullScan(Invitation.objects.for_user(self.user))
+    
+    def test_activity_feed(self):
+        self.assertNoFullScan(ActivityEvent.objects.for_user(self.user)[:10])
+    
+    def test_archival(self):
+        presents = transitions.get_presents(status=Present.STATUS.BOUGHT,
+                                            older_than=30)
+        # Like transitions.set_status does
+        presents = presents.exclude(status=Present.STATUS.ARCHIVED)
+        self.assertNoFullScan(presents)
+
+
+class ActivityFeedTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='alice')
+        self.bob = User.objects.create_user('bob')
+        self.client.login(username='alice', password='alice')
+        self.url = reverse('kdo-landing')
+    
+    def create_present(self, title):
+        present = Present.objects.create(title=title, giftee="Zoe")
+        present.participants.create(user=self.bob)
+        present.comment_set.create(author=self.bob, text="About %s" % title)
+        present.participants.create(user=self.alice)
+        return present
+    
+    def test_feed_events(self):
+        lego = self.create_present("Lego")
+        self.assertEqual(ActivityEvent.objects.filter(user=self.alice).count(),
+                         2)
+        lego.comment_set.create(author=self.alice, text="Great idea")
+        self.assertEqual(ActivityEvent.objects.filter(user=self.bob).count(), 3)
+        
+        lego.participants.get(user=self.alice).delete()
+        self.assertFalse(ActivityEvent.objects.filter(user=self.alice))
+        
+        events = ActivityEvent.objects.count()
+        self.assertEqual(ActivityEvent.objects.rebuild(), events)
+    
+    def test_constant_number_of_queries(self):
+        self.create_present("Lego")
+        self.client.get(self.url) # fill the invitation count cache
+        with self.assertNumQueries(3):
+            self.client.get(self.url)
+        
+        for i in range(5):
+            self.create_present("Present %d" % i)
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url)
+        self.assertContains(response, "About Present 4")
+
+
+@override_settings(KDO_INSTRUMENTATION=True, KDO_QUERY_BUDGET_RAISE=True)
+class InstrumentationMiddlewareTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='alice')
+        self.present = Present.objects.create(title="Lego", giftee="Zoe")
+        self.present.participants.create(user=self.user)
+        self.url = reverse('kdo-present-detail', args=[self.present.pk])
+        self.client.login(username='alice', password='alice')
+    
+    def test_server_timing_header(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('queries"', response['Server-Timing'])
+        self.assertIn('template;dur=', response['Server-Timing'])
+        self.assertIn('total;dur=', response['Server-Timing'])
+    
+    def test_query_timer(self):
+        with self.assertNumQueries(2):
+            with QueryTimer() as timer:
+                list(Present.objects.all())
+                with QueryTimer() as inner:
+                    list(User.objects.all())
+        self.assertEqual((timer.count, inner.count), (2, 1))
+        self.assertGreater(timer.duration, inner.duration)
+        self.assertGreater(inner.duration, 0)
+        self.assertNotIn('cursor', connections[DEFAULT_DB_ALIAS].__dict__)
+    
+    def test_present_list_within_budget(self):
+        bob = User.objects.create_user('bob')
+        for i in range(5):
+            present = Present.objects.create(title="Present %d" % i,
+                                             giftee="Zoe", bought_by=bob,
+                                             status=Present.STATUS.BOUGHT)
+            present.participants.create(user=self.user)
+        cache.clear() # render every row
+        response = self.client.get(reverse('kdo-present-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'title="bob"', count=5)
+    
+    def test_over_budget_raises(self):
+        with self.settings(KDO_QUERY_BUDGETS={'kdo-present-detail': 1}):
+            self.assertRaises(QueryBudgetExceeded, self.client.get, self.url)
+    
+    def test_disabled(self):
+        with self.settings(KDO_INSTRUMENTATION=False):
+            client = self.client_class()
+            response = client.get(reverse('kdo-welcome'))
+        self.assertNotIn('Server-Timing', response)
+
+
+class ProfilingMiddlewareTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.settings_override = override_settings(
+            KDO_PROFILING=True, KDO_PROFILING_DIR=self.directory,
+            KDO_PROFILING_SAMPLE_RATE=0, KDO_PROFILING_MAX_FILES=2)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.url = reverse('kdo-welcome')
+    
+    def test_profiles_requests_with_a_token(self):
+        self.client.get(self.url)
+        self.client.get(self.url, HTTP_X_KDO_PROFILE='forged')
+        self.assertEqual(os.listdir(self.directory), [])
+        
+        for i in range(3):
+            self.client.get(self.url, HTTP_X_KDO_PROFILE=make_profiling_token())
+        profiles = os.listdir(os.path.join(self.directory, 'kdo-welcome'))
+        self.assertEqual(len(profiles), 2)
+        
+        out = StringIO()
+        call_command('profile_report', limit=5, stdout=out)
+        self.assertIn('kdo-welcome (2 profiles)', out.getvalue())
+    
+    def test_profile_removed_by_another_process(self):
+        directory = os.path.join(self.directory, 'kdo-welcome')
+        os.makedirs(directory)
+        # A profile listed by os.walk but gone by the time it is stat'ed
+        os.symlink(os.path.join(directory, 'missing'),
+                   os.path.join(directory, '0.000000-1.prof'))
+        self.assertEqual(list_profiles(directory), [])
+        
+        with self.settings(KDO_PROFILING_MAX_SIZE=0):
+            response = self.client.get(self.url,
+                                       HTTP_X_KDO_PROFILE=make_profiling_token())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list_profiles(directory), [])
+
+
+class EmailTemplateTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('alice', email='alice@example.com')
+        present = Present.objects.create(title="Lego", giftee="Zoe")
+        self.invitation = Invitation.objects.create(
+            present=present, sent_by=user, sent_to='bob@example.com')
+        emails.CachedEmailTemplate._templates.clear()
+    
+    def render(self):
+        return emails.InvitationEmail().render({
+            'site': Site.objects.get_current(),
+            'invitation': self.invitation,
+        })
+    
+    def test_templates_compiled_once(self):
+        first = self.render()
+        
+        def fail(*args, **kwargs):
+            raise AssertionError("a template was compiled again")
+        
+        originals = emails.get_template, emails.Template
+        emails.get_template = emails.Template = fail
+        try:
+            second = self.render()
+        finally:
+            emails.get_template, emails.Template = originals
+        self.assertEqual(second.subject, first.subject)
+        self.assertEqual(second.body, first.body)
+        self.assertEqual(second.to, ['bob@example.com'])
+        self.assertEqual(second.extra_headers['Reply-To'], 'alice@example.com')
+    
+    def test_templates_per_language(self):
+        subjects = []
+        for language in ('en', 'fr'):
+            with translation.override(language):
+                subjects.append(self.render().subject)
+        self.assertNotEqual(subjects[0], subjects[1])
+        self.assertEqual(len(emails.CachedEmailTemplate._templates), 6)
+
+
+class FailingBackend(locmem.EmailBackend):
+    def send_messages(self, messages):
+        raise IOError("Connection refused")
+
+
+class UnreachableBackend(locmem.EmailBackend):
+    def open(self):
+        raise IOError("Connection refused")
+
+
+class OutboxTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='alice')
+        self.present = Present.objects.create(title="Lego", giftee="Zoe")
+        self.present.participants.create(user=self.user)
+        self.client.login(username='alice', password='alice')
+    
+    def invite(self, email):
+        url = reverse('kdo-present-invite-participant', args=[self.present.pk])
+        return self.client.post(url, {'emails': email})
+    
+    def test_invitation_is_queued_then_sent(self):
+        self.invite('bob@example.com')
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboundEmail.objects.due().count(), 1)
+        
+        call_command('send_outbox', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['bob@example.com'])
+        self.assertEqual(OutboundEmail.objects.due().count(), 0)
+    
+    def test_failed_email_is_retried_later(self):
+        self.invite('bob@example.com')
+        backend = 'noyel.kdo.tests.FailingBackend'
+        with self.settings(EMAIL_BACKEND=backend):
+            self.assertEqual(OutboundEmail.objects.send_due(), (0, 1))
+        
+        email = OutboundEmail.objects.get()
+        self.assertEqual(email.attempts, 1)
+        self.assertIsNone(email.sent_on)
+        self.assertGreater(email.next_attempt_on, email.created_on)
+        self.assertEqual(OutboundEmail.objects.due().count(), 0)
+    
+    def test_unreachable_server(self):
+        self.invite('bob@example.com')
+        self.invite('carol@example.com')
+        backend = 'noyel.kdo.tests.UnreachableBackend'
+        with self.settings(EMAIL_BACKEND=backend):
+            self.assertEqual(OutboundEmail.objects.send_due(), (0, 2))
+        
+        for email in OutboundEmail.objects.all():
+            self.assertEqual(email.attempts, 1)
+            self.assertIn("Connection refused", email.last_error)
+            self.assertIsNotNone(email.next_attempt_on)
+        self.assertEqual(OutboundEmail.objects.due().count(), 0)
+
+
+class BulkInvitationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='alice')
+        self.present = Present.objects.create(title="Lego", giftee="Zoe")
+        self.present.participants.create(user=self.user)
+        self.friends = []
+        for i in range(3):
+            friend = User.objects.create_user('friend%d' % i)
+            other = Present.objects.create(title="Other", giftee="Zoe")
+            other.participants.create(user=self.user)
+            other.participants.create(user=friend)
+            self.friends.append(friend)
+        friend = self.friends[2]
+        friend.emails.create(email='friend2@example.com', verified=True)
+        Invitation.objects.create(present=self.present, sent_by=self.user,
+                                  sent_to='old@example.com')
+        self.client.login(username='alice', password='alice')
+    
+    def test_invite_friends_and_emails(self):
+        url = reverse('kdo-present-invite-participant', args=[self.present.pk])
+        response = self.client.post(url, {
+            'friends': [self.friends[0].pk, self.friends[1].pk],
+            'emails': 'a@example.com, b@example.com\nold@example.com '
+                      'friend2@example.com',
+        })
+        self.assertEqual(response.status_code, 302)
+        
+        participants = self.present.participants.values_list('user', flat=True)
+        self.assertEqual(set(participants),
+                         set([self.user.pk] + [f.pk for f in self.friends]))
+        self.assertEqual(Present.objects.get(pk=self.present.pk)\
+                                        .participant_count, 4)
+        invited = self.present.invitation_set.values_list('sent_to', flat=True)
+        self.assertEqual(set(invited), set(['old@example.com', 'a@example.com',
+                                            'b@example.com']))
+        self.assertEqual(OutboundEmail.objects.count(), 2)
+    
+    def test_concurrent_invitation(self):
+        class StaleForm(PresentInvitationForm):
+            # The check runs before the other request inserts its rows
+            def _participating(self, users):
+                return set()
+            
+            def _invited(self, emails):
+                return set()
+        
+        form = StaleForm({
+            'friends': [self.friends[0].pk, self.friends[1].pk],
+            'emails': 'a@example.com b@example.com',
+        }, user=self.user, present=self.present)
+        self.assertTrue(form.is_valid())
+        self.present.participants.create(user=self.friends[0])
+        Invitation.objects.create(present=self.present, sent_by=self.user,
+                                  sent_to='a@example.com')
+        
+        users, invitations, invited = form.save()
+        self.assertEqual(users, [self.friends[1]])
+        self.assertEqual([i.sent_to for i in invitations], ['b@example.com'])
+        self.assertEqual(invited, ['a@example.com'])
+        self.assertEqual(self.present.participants.count(), 3)
+        self.assertEqual(Present.objects.get(pk=self.present.pk)\
+                                        .participant_count, 3)
+        self.assertEqual(self.present.invitation_set.count(), 3)
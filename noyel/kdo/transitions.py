@@ -0,0 +1,66 @@
+"""Status changes applied to many presents at once (from the present list or
+the `archive_presents` command), each with a single UPDATE query whatever the
+number of presents.
+
+"""
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+
+from noyel.kdo.cache import invalidate_data_version
+from noyel.kdo.models import Present, Participant
+from noyel.kdo.utils import normalize_giftee
+
+# A present can only become BOUGHT through its purchase form, which records
+# the buyer.
+TARGETS = [status for status, label in Present.STATUS.choices
+           if status != Present.STATUS.BOUGHT]
+# The other statuses mean the present isn't bought (anymore).
+KEEP_BUYER = [Present.STATUS.BOUGHT, Present.STATUS.ARCHIVED]
+
+
+def get_presents(user=None, giftee=None, status=None, older_than=None,
+                 pks=None):
+    """Return the queryset of the presents to change, filtered by
+    participant, giftee, status, age (number of days since the last change)
+    and primary key.
+    
+    """
+    qs = Present.objects.all()
+    if user is not None:
+        qs = qs.filter(participants__user=user)
+    if giftee:
+        qs = qs.filter(giftee_key=normalize_giftee(giftee))
+    if status is not None:
+        qs = qs.filter(status=status)
+    if older_than is not None:
+        qs = qs.filter(updated_on__lt=timezone.now() -
+                                      timedelta(days=older_than))
+    if pks is not None:
+        qs = qs.filter(pk__in=pks)
+    return qs
+
+
+def set_status(queryset, status):
+    """Give the given status to the presents of the queryset and return the
+    number of presents that changed.
+    
+    The participants of the changed presents get a new data version. The
+    buyer of the presents is cleared unless the status is in KEEP_BUYER.
+    
+    """
+    queryset = queryset.exclude(status=status)
+    user_pks = list(Participant.objects.filter(present__in=queryset)
+                                       .values_list('user', flat=True)
+                                       .distinct())
+    # update() skips auto_now: set updated_on explicitly so that the cached
+    # template fragments of the presents are refreshed.
+    values = {'status': status, 'updated_on': timezone.now(),
+              'version': F('version') + 1}
+    if status not in KEEP_BUYER:
+        values['bought_by'] = None
+    count = queryset.update(**values)
+    if count:
+        invalidate_data_version(user_pks)
+    return count
@@ -5,6 +5,8 @@ urlpatterns = patterns('noyel.kdo.views',
     
     url(r'^api/search/giftee/$', 'search_giftee', name='kdo-search-giftee'),
     url(r'^api/search/friend/$', 'search_friend', name='kdo-search-friend'),
+    url(r'^api/search/present/$', 'search_present', name='kdo-search-present'),
+    url(r'^api/dictionary/$', 'dictionary', name='kdo-dictionary'),
 )
 
 urlpatterns.extend(patterns('noyel.kdo.views.comment',
@@ -18,6 +20,10 @@ urlpatterns.extend(patterns('noyel.kdo.views.comment',
 urlpatterns.extend(patterns('noyel.kdo.views.present',
     url(r'^presents/$', 'base_list', name='kdo-present-list'),
     url(r'^presents/create/$', 'create', name='kdo-present-create'),
+    url(r'^presents/search/$', 'search', name='kdo-present-search'),
+    url(r'^presents/export/$', 'export_presents', name='kdo-present-export'),
+    url(r'^presents/import/$', 'import_presents', name='kdo-present-import'),
+    url(r'^presents/bulk-status/$', 'bulk_status', name='kdo-present-bulk-status'),
     url(r'^presents/(?P<pk>\d+)/$', 'detail', name='kdo-present-detail'),
     url(r'^presents/(?P<pk>\d+)/update/$', 'update', name='kdo-present-update'),
     url(r'^presents/(?P<pk>\d+)/delete/$', 'delete', name='kdo-present-delete'),
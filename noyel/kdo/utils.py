@@ -0,0 +1,79 @@
+import re
+import unicodedata
+
+from django.template.defaultfilters import linebreaks_filter
+from django.utils.encoding import force_text
+from django.utils.html import escape, urlize
+from django.utils.safestring import mark_safe
+
+_whitespace_re = re.compile(r'\s+', re.UNICODE)
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize_giftee(name):
+    """Return a normalized version of the given giftee's name suitable for
+    comparisons: lowercased, stripped of accents and with whitespace collapsed.
+    
+    >>> normalize_giftee(u'  Zo\xe9   Dupont ')
+    u'zoe dupont'
+    
+    """
+    name = unicodedata.normalize('NFKD', force_text(name))
+    name = u''.join(c for c in name if not unicodedata.combining(c))
+    return _whitespace_re.sub(u' ', name).strip().lower()
+
+
+def render_text(text, links=False):
+    """Return the HTML for the given user-submitted text: escaped, split in
+    paragraphs and, if `links` is True, with its URLs turned into links.
+    
+    The result is stored along with the text so that templates don't have to
+    run the (slow) filters on every render.
+    
+    """
+    if links:
+        text = mark_safe(urlize(text, nofollow=True, autoescape=True))
+    return linebreaks_filter(text, autoescape=True)
+
+
+def tokenize(text):
+    """Return the list of the normalized words of the given text (see
+    normalize_giftee), ignoring one-letter words.
+    
+    >>> tokenize(u'Le Ch\xe2teau-fort Lego!')
+    [u'le', u'chateau', u'fort', u'lego']
+    
+    """
+    return [word[:50] for word in _word_re.findall(normalize_giftee(text))
+            if len(word) > 1]
+
+
+def highlight(text, terms, length=None):
+    """Return the escaped text with the words starting with one of the given
+    (normalized) terms wrapped in <mark> tags.
+    
+    If `length` is given, only return an excerpt of about that many
+    characters around the first highlighted word.
+    
+    """
+    text = force_text(text)
+    matches = [m for m in _word_re.finditer(text)
+               if normalize_giftee(m.group()).startswith(tuple(terms))]
+    start, end, prefix, suffix = 0, len(text), u'', u''
+    if length is not None and len(text) > length:
+        first = matches[0].start() if matches else 0
+        start = max(0, first - length // 4)
+        end = min(len(text), start + length)
+        prefix = u'\u2026' if start else u''
+        suffix = u'\u2026' if end < len(text) else u''
+    
+    parts, position = [prefix], start
+    for match in matches:
+        if match.start() < start or match.end() > end:
+            continue
+        parts.append(escape(text[position:match.start()]))
+        parts.append(u'<mark>%s</mark>' % escape(match.group()))
+        position = match.end()
+    parts.append(escape(text[position:end]))
+    parts.append(suffix)
+    return mark_safe(u''.join(parts))
@@ -1,58 +1,61 @@
 import json
 
-from django.db.models import Count
+from django.core.urlresolvers import reverse
 from django.http import HttpResponse
 from django.views import generic
 
-from noyel.kdo.mixins import LoginRequiredMixin
-from noyel.kdo.models import Present, Comment
+from noyel.kdo.cache import data_version, user_data_condition
+from noyel.kdo.mixins import LoginRequiredMixin, PresentSearchMixin
+from noyel.kdo.models import ActivityEvent, GifteeEntry
 from noyel.account.utils import get_friends_for_user
 
 
 class LandingView(LoginRequiredMixin, generic.TemplateView):
-    """Show latest presents and comments."""
+    """Show the latest events of the user's activity feed (new presents and
+    comments).
+    
+    """
     template_name = "kdo/landing.html"
     
     def get_context_data(self, **kwargs):
         context = super(LandingView, self).get_context_data(**kwargs)
-        context.update({
-            'latest_presents': Present.objects.filter(
-                                   participants__user=self.request.user
-                               ).exclude(
-                                   status=Present.STATUS.ARCHIVED,
-                               ).order_by('-created_on')[:10],
-            'latest_comments': Comment.objects.filter(
-                                   present__participants__user=self.request.user
-                               ).exclude(
-                                   present__status=Present.STATUS.ARCHIVED,
-                               ).order_by('-posted_on')[:10],
-        })
+        events = ActivityEvent.objects.for_user(self.request.user)
+        context['latest_events'] = events[:10]
         return context
 
 landing = LandingView.as_view()
 
 
 class GifteeSearchView(LoginRequiredMixin, generic.View): # TODO: json mixin?
-    """Given a search query, return a json of a list of matching giftees."""
+    """Given a search query, return a json of a list of matching giftees.
+    The most frequent giftees come first and at most `limit` of them are
+    returned.
+    
+    """
+    default_limit = 8
+    max_limit = 50
+    
+    def get_limit(self):
+        try:
+            limit = int(self.request.GET.get('limit', self.default_limit))
+        except ValueError:
+            limit = self.default_limit
+        return max(1, min(limit, self.max_limit))
     
     def get(self, request):
-        search = request.GET.get('q')
-        qs = Present.objects.filter(participants__user=request.user,
-                                    giftee__startswith=search)
-        qs = qs.values('giftee').annotate(count=Count('pk'))
-        l = sorted(qs, key=lambda row: row['count'], reverse=True)
-        l = [row['giftee'] for row in l]
+        search = request.GET.get('q', u'')
+        l = GifteeEntry.objects.search(request.user, search, self.get_limit())
         
-        return HttpResponse(json.dumps(l), mimetype='application/json')
+        return HttpResponse(json.dumps(list(l)), mimetype='application/json')
 
-search_giftee = GifteeSearchView.as_view()
+search_giftee = user_data_condition(GifteeSearchView.as_view())
 
 
 class FriendSearchView(LoginRequiredMixin, generic.View): # TODO: json mixin
     """Return a json list of the current user's friends matchin the query."""
     
     def get(self, request):
-        search = request.GET.get('q')
+        search = request.GET.get('q', u'')
         qs = get_friends_for_user(request.user)
         qs = qs.filter(username__startswith=search).distinct()
         qs = qs.values_list('username', flat=True)
@@ -60,4 +63,51 @@ class FriendSearchView(LoginRequiredMixin, generic.View): # TODO: json mixin
         return HttpResponse(json.dumps(list(qs)),
                             mimetype='application/json')
 
-search_friend = FriendSearchView.as_view()
+search_friend = user_data_condition(FriendSearchView.as_view())
+
+
+class PresentSearchView(LoginRequiredMixin, PresentSearchMixin, generic.View):
+    """Return a json list of the current user's presents matching the query,
+    best first, with their highlighted title and excerpt.
+    
+    """
+    def get(self, request):
+        results = [{
+            'pk': present.pk,
+            'url': reverse('kdo-present-detail', args=[present.pk]),
+            'title': present.title_html,
+            'excerpt': present.excerpt_html,
+            'score': present.score,
+        } for present in self.get_results()]
+        
+        return HttpResponse(json.dumps(results), mimetype='application/json')
+
+search_present = user_data_condition(PresentSearchView.as_view())
+
+
+class DictionaryView(LoginRequiredMixin, generic.View):
+    """Return a json object with all the current user's giftees (most frequent
+    first, along with their normalized key and their number of presents) and
+    friends, so that the typeaheads can filter them locally.
+    
+    The object carries the user's data version: if it matches the `since`
+    parameter, the lists are left out and `unchanged` is true.
+    
+    """
+    def get(self, request):
+        version = data_version(request.user.pk)
+        data = {'version': version}
+        if request.GET.get('since') == version:
+            data['unchanged'] = True
+        else:
+            giftees = GifteeEntry.objects.filter(user=request.user)
+            giftees = giftees.order_by('-present_count', 'key')
+            friends = get_friends_for_user(request.user).order_by('username')
+            data['giftees'] = map(list, giftees.values_list('name', 'key',
+                                                            'present_count'))
+            data['friends'] = list(friends.values_list('username', flat=True))
+        
+        return HttpResponse(json.dumps(data, separators=(',', ':')),
+                            mimetype='application/json')
+
+dictionary = user_data_condition(DictionaryView.as_view())
@@ -1,11 +1,11 @@
 from django.core.urlresolvers import reverse
-from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext_lazy as _
 from django.views import generic
 
 from noyel.kdo.forms import CommentCreateForm, CommentUpdateForm
-from noyel.kdo.mixins import LoginRequiredMixin, UserQuerysetMixin
-from noyel.kdo.models import Present, Comment
+from noyel.kdo.mixins import (LoginRequiredMixin, UserQuerysetMixin,
+                              get_present_or_404)
+from noyel.kdo.models import Comment
 
 from toolbox.messages import FormMessageMixin, DeleteMessageMixin
 from toolbox.next import NextMixin
@@ -29,8 +29,7 @@ class CreateView(LoginRequiredMixin, NextMixin, FormMessageMixin, generic.Create
         return kwargs
     
     def dispatch(self, request, *args, **kwargs):
-        self.present = get_object_or_404(Present, pk=kwargs['pk'],
-                                         participants__user=request.user)
+        self.present = get_present_or_404(request.user, kwargs['pk'])
         return super(CreateView, self).dispatch(request, *args, **kwargs)
 
 create = CreateView.as_view()
@@ -1,17 +1,17 @@
 from django.core.urlresolvers import reverse
 from django.core.mail import send_mail
 from django.conf import settings
-from django.db import IntegrityError
-from django.shortcuts import get_object_or_404
-from django.utils.translation import ugettext_lazy as _
+from django.db import transaction
+from django.utils.translation import ugettext_lazy as _, ungettext
 from django.utils.timezone import now
 
 from django.views import generic
 from django.views.generic.detail import SingleObjectMixin
 
 from noyel.kdo import forms as kdo_forms
-from noyel.kdo.mixins import LoginRequiredMixin, UserQuerysetMixin
-from noyel.kdo.models import Present, Invitation
+from noyel.kdo.mixins import (LoginRequiredMixin, PresentAccessMixin,
+                              get_present_or_404)
+from noyel.kdo.models import Invitation
 
 from toolbox.messages import MessageMixin, FormMessageMixin, DeleteMessageMixin
 from toolbox.next import NextMixin
@@ -35,8 +35,7 @@ class InviteParticipantView(LoginRequiredMixin, NextMixin, MessageMixin, generic
         return reverse('kdo-present-detail', args=[self.present.pk])
     
     def dispatch(self, request, *args, **kwargs):
-        self.present = get_object_or_404(Present, pk=kwargs['pk'],
-                                         participants__user=request.user)
+        self.present = get_present_or_404(request.user, kwargs['pk'])
         return super(InviteParticipantView, self).dispatch(request, *args,
                                                            **kwargs)
     
@@ -46,56 +45,57 @@ class InviteParticipantView(LoginRequiredMixin, NextMixin, MessageMixin, generic
         kwargs['present'] = self.present
         return kwargs
     
+    @transaction.atomic
     def form_valid(self, form):
-        """If a user was given, then add it to the participants list right away.
+        """Add the selected friends (and the friends owning the given email
+        addresses) to the participants list right away.
         
-        If an email was given and it corresponds to a friend, then add it too.
-        
-        Otherwise, send an invitation email to the given address.
+        Send an invitation email to the other addresses.
         
         """
-        users, email = form.cleaned_data['friends'], form.cleaned_data['email']
+        users, invitations, already_invited = form.save()
+        for invitation in invitations:
+            invitation.send_email(self.request)
+        
         if users:
-            for user in users:
-                try:
-                    self.present.participants.create(user=user,
-                                                     present=self.present)
-                except IntegrityError: # already participating
-                    pass
             msg = _("The users have been added to the present's participants "
                     "successfully.")
             self.messages.success(msg)
-            return super(InviteParticipantView, self).form_valid(form)
-
-        try:
-            invitation = form.save_invitation()
-        except IntegrityError: # invitation already sent
-            msg = _("The user \"%(email_address)s\" has already been "
-                    "invited to this present.")
+        if invitations:
+            msg = ungettext("An email has been sent to the user inviting them "
+                            "to participate to this present.",
+                            "An email has been sent to %(count)d users "
+                            "inviting them to participate to this present.",
+                            len(invitations))
+            self.messages.success(msg % {'count': len(invitations)})
+        if already_invited:
+            msg = ungettext("The user \"%(email_address)s\" has already been "
+                            "invited to this present.",
+                            "The users \"%(email_address)s\" have already "
+                            "been invited to this present.",
+                            len(already_invited))
             self.messages.error(msg % {
-                'email_address': form.cleaned_data['user'],
+                'email_address': u', '.join(already_invited),
                 })
-            return self.form_invalid(form)
         
-        invitation.send_email(self.request)
-        msg = _("An email has been sent to the user inviting them to "
-                "participate to this present.")
-        self.messages.success(msg)
+        if not users and not invitations:
+            return self.form_invalid(form)
         return super(InviteParticipantView, self).form_valid(form)
 
 invite_participant = InviteParticipantView.as_view()
 
 
-class ReSendView(LoginRequiredMixin, UserQuerysetMixin, MessageMixin, SingleObjectMixin, NextMixin, generic.View):
+class ReSendView(LoginRequiredMixin, PresentAccessMixin, MessageMixin, SingleObjectMixin, NextMixin, generic.View):
     """Re-send the invitation email and update its sent_on attribute."""
     model = Invitation
     pk_url_kwarg = 'token'
-    user_field_name = 'present__participants__user'
+    present_field_name = 'present'
     
     @property
     def default_next_url(self):
         return reverse('kdo-present-detail', args=[self.invitation.present_id])
     
+    @transaction.atomic
     def post(self, request, *args, **kwargs):
         self.invitation = self.get_object()
         self.invitation.send_email(self.request)
@@ -153,18 +153,18 @@ class ListView(LoginRequiredMixin, generic.ListView):
 list = ListView.as_view()
 
 
-class DeleteView(LoginRequiredMixin, UserQuerysetMixin, DeleteMessageMixin, NextMixin, generic.DeleteView):
+class DeleteView(LoginRequiredMixin, PresentAccessMixin, DeleteMessageMixin, NextMixin, generic.DeleteView):
     """"Delete an invitation. Only accessible to participants of the
     invitations's present.
     
     """
     template_name = 'kdo/invitation_delete.html'
     model = Invitation
-    user_field_name = 'present__participants__user'
+    present_field_name = 'present'
     pk_url_kwarg = 'token'
     
     @property
     def default_next_url(self):
-        return reverse('kdo-present-detail', args=(self.present.pk,))
+        return reverse('kdo-present-detail', args=(self.object.present_id,))
 
 delete = DeleteView.as_view()
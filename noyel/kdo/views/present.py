@@ -1,13 +1,17 @@
 from django.core.urlresolvers import reverse, reverse_lazy
 from django.contrib.auth.models import User
-from django.db.models import Count
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import ugettext_lazy as _, ungettext
 from django.views import generic
 
-from noyel.kdo import forms as kdo_forms
-from noyel.kdo.mixins import LoginRequiredMixin, UserQuerysetMixin
+from noyel.kdo import export, importer, forms as kdo_forms
+from noyel.kdo.cache import user_data_condition
+from noyel.kdo.mixins import (LoginRequiredMixin, UserQuerysetMixin,
+                              PresentAccessMixin, PresentSearchMixin,
+                              KeysetPaginationMixin, get_present_or_404)
 from noyel.kdo.models import Present, Comment
+from noyel.kdo.utils import normalize_giftee
 
 from toolbox.messages import MessageMixin, FormMessageMixin, DeleteMessageMixin
 from toolbox.next import NextMixin
@@ -20,17 +24,29 @@ class ActivePresentsMixin(object):
         return queryset
 
 
-class ListView(LoginRequiredMixin, UserQuerysetMixin, ActivePresentsMixin, generic.ListView):
-    """List all presents the current user has access to."""
+class ListView(LoginRequiredMixin, UserQuerysetMixin, ActivePresentsMixin, KeysetPaginationMixin, generic.ListView):
+    """List all presents the current user has access to, most recently updated
+    first, one page at a time.
+    
+    """
     model = Present
     user_field_name = 'participants__user'
     
     def get_queryset(self):
+        """Load the buyers along with the presents: the rows that aren't in
+        the template fragment cache show them.
+        
+        """
         base = super(ListView, self).get_queryset()
-        annotated = base.annotate(count_comments=Count('comment'))
-        return annotated.order_by('-updated_on')
+        return base.select_related('bought_by')
+    
+    def get_context_data(self, **kwargs):
+        context = super(ListView, self).get_context_data(**kwargs)
+        context['bulk_status_form'] = kdo_forms.BulkStatusForm(
+            user=self.request.user)
+        return context
 
-base_list = ListView.as_view()
+base_list = user_data_condition(ListView.as_view())
 
 
 class ListForGifteeView(ListView):
@@ -42,26 +58,52 @@ class ListForGifteeView(ListView):
     
     def get_queryset(self):
         base = super(ListForGifteeView, self).get_queryset()
-        return base.filter(giftee__iexact=self.kwargs['giftee'])
+        return base.filter(giftee_key=normalize_giftee(self.kwargs['giftee']))
     
     def get_context_data(self, **kwargs):
         context = super(ListForGifteeView, self).get_context_data(**kwargs)
         context['giftee'] = self.kwargs['giftee']
         return context
 
-list_for_giftee = ListForGifteeView.as_view()
+list_for_giftee = user_data_condition(ListForGifteeView.as_view())
 
 
-class DetailView(LoginRequiredMixin, UserQuerysetMixin, generic.DetailView):
+class DetailView(LoginRequiredMixin, PresentAccessMixin, generic.DetailView):
     """Show detail for a given present. Only accessible to users in the
     `participants` field.
     
     """
     template_name = 'kdo/present_detail.html'
     model = Present
-    user_field_name = 'participants__user'
+    
+    def get_queryset(self):
+        """Load everything the template needs upfront so that the number of
+        queries doesn't depend on the number of participants or comments.
+        
+        """
+        base = super(DetailView, self).get_queryset()
+        return base.select_related('bought_by')\
+                   .prefetch_related('participants__user',
+                                     'comment_set__author',
+                                     'invitation_set')
 
-detail = DetailView.as_view()
+detail = user_data_condition(DetailView.as_view())
+
+
+class SearchView(LoginRequiredMixin, PresentSearchMixin, generic.TemplateView):
+    """Search the titles, descriptions, links and comments of the presents the
+    current user has access to.
+    
+    """
+    template_name = 'kdo/present_search.html'
+    
+    def get_context_data(self, **kwargs):
+        context = super(SearchView, self).get_context_data(**kwargs)
+        context['query'] = self.get_query()
+        context['results'] = self.get_results()
+        return context
+
+search = SearchView.as_view()
 
 
 class CreateView(LoginRequiredMixin, NextMixin, FormMessageMixin, generic.CreateView):
@@ -97,7 +139,23 @@ class CreateForGifteeView(CreateView):
 create_for_giftee = CreateForGifteeView.as_view()
 
 
-class UpdateView(LoginRequiredMixin, UserQuerysetMixin, NextMixin, FormMessageMixin, generic.UpdateView):
+class EditConflictMixin(object):
+    """Show the form again with an error when its present was changed by
+    someone else (see kdo_forms.VersionedFormMixin).
+    
+    It must come before FormMessageMixin in the bases so that a conflict
+    doesn't get the success message.
+    
+    """
+    def form_valid(self, form):
+        try:
+            return super(EditConflictMixin, self).form_valid(form)
+        except kdo_forms.EditConflict as e:
+            form.conflict(e)
+            return self.form_invalid(form)
+
+
+class UpdateView(LoginRequiredMixin, PresentAccessMixin, NextMixin, EditConflictMixin, FormMessageMixin, generic.UpdateView):
     """Update a present. Only available if the current user is part of the
     `participants` field.
     
@@ -105,7 +163,6 @@ class UpdateView(LoginRequiredMixin, UserQuerysetMixin, NextMixin, FormMessageMi
     template_name = 'kdo/present_update.html'
     model = Present
     form_class = kdo_forms.PresentUpdateForm
-    user_field_name = 'participants__user'
     
     form_valid_message = _("The present has been updated successfully.")
     @property
@@ -115,13 +172,12 @@ class UpdateView(LoginRequiredMixin, UserQuerysetMixin, NextMixin, FormMessageMi
 update = UpdateView.as_view()
 
 
-class DeleteView(LoginRequiredMixin, UserQuerysetMixin, NextMixin, DeleteMessageMixin, generic.DeleteView):
+class DeleteView(LoginRequiredMixin, PresentAccessMixin, NextMixin, DeleteMessageMixin, generic.DeleteView):
     """Delete a present. Only available if the current user is part of the
     `availabl_to` field.
     
     """
     model = Present
-    user_field_name = 'participants__user'
     default_next_url = reverse_lazy('kdo-present-list')
     delete_message = _("The present has been deleted successfully.")
 
@@ -139,8 +195,7 @@ class RemoveParticipantView(LoginRequiredMixin, NextMixin, MessageMixin, generic
         return reverse('kdo-present-detail', args=[self.present.pk])
     
     def post(self, request, *args, **kwargs):
-        self.present = get_object_or_404(Present, pk=kwargs['pk'],
-                                         participants__user=request.user)
+        self.present = get_present_or_404(request.user, kwargs['pk'])
         self.user = get_object_or_404(User, pk=kwargs['user_pk'],
                                       participant__present=self.present)
         self.present.participants.filter(user=self.user).delete()
@@ -153,12 +208,11 @@ class RemoveParticipantView(LoginRequiredMixin, NextMixin, MessageMixin, generic
 remove_participant = RemoveParticipantView.as_view()
 
 
-class PurchaseView(LoginRequiredMixin, UserQuerysetMixin, NextMixin, MessageMixin, generic.UpdateView):
+class PurchaseView(LoginRequiredMixin, PresentAccessMixin, NextMixin, MessageMixin, EditConflictMixin, generic.UpdateView):
     """Mark the current user as having purchased the given present."""
     template_name = 'kdo/present_purchase.html'
     model = Present
     form_class = kdo_forms.PresentPurchaseForm
-    user_field_name = 'participants__user'
     default_next_url = reverse_lazy('kdo-present-list')
     form_valid_message = _("You have been marked as the buyer of this present "
                            "successfully.")
@@ -173,3 +227,106 @@ class PurchaseView(LoginRequiredMixin, UserQuerysetMixin, NextMixin, MessageMixi
         return kwargs
 
 purchase = PurchaseView.as_view()
+
+
+class BulkStatusView(LoginRequiredMixin, NextMixin, MessageMixin, generic.FormView):
+    """Change the status of the presents checked in the list (or of all the
+    presents matching the filters) with a single query, then go back to the
+    list.
+    
+    """
+    http_method_names = ['post']
+    form_class = kdo_forms.BulkStatusForm
+    default_next_url = reverse_lazy('kdo-present-list')
+    
+    def get_form_kwargs(self):
+        kwargs = super(BulkStatusView, self).get_form_kwargs()
+        kwargs['user'] = self.request.user
+        return kwargs
+    
+    def form_valid(self, form):
+        count = form.save()
+        msg = ungettext("The status of %(count)d present has been changed.",
+                        "The status of %(count)d presents has been changed.",
+                        count)
+        self.messages.success(msg % {'count': count})
+        return self.redirect()
+    
+    def form_invalid(self, form):
+        for errors in form.errors.values():
+            for error in errors:
+                self.messages.error(error)
+        return self.redirect()
+
+bulk_status = BulkStatusView.as_view()
+
+
+
+class ExportView(LoginRequiredMixin, generic.FormView):
+    """Show the export form then, once it's submitted (with GET), stream the
+    current user's presents as a CSV or NDJSON file.
+    
+    """
+    template_name = 'kdo/present_export.html'
+    form_class = kdo_forms.ExportForm
+    
+    def get(self, request, *args, **kwargs):
+        if 'format' not in request.GET:
+            return super(ExportView, self).get(request, *args, **kwargs)
+        form = self.form_class(request.GET)
+        if form.is_valid():
+            return self.form_valid(form)
+        return self.form_invalid(form)
+    
+    def form_valid(self, form):
+        filters = form.cleaned_data.copy()
+        format = filters.pop('format')
+        presents = export.get_presents(self.request.user, **filters)
+        lines = export.export(export.iter_presents(presents), format)
+        response = StreamingHttpResponse(lines,
+                                         content_type=export.FORMATS[format])
+        response['Content-Disposition'] = 'attachment; filename=presents.%s' \
+                                          % format
+        return response
+
+export_presents = ExportView.as_view()
+
+
+
+class ImportView(LoginRequiredMixin, MessageMixin, generic.FormView):
+    """Create presents in bulk from a CSV or JSON file. The current user is
+    added to the participants of each of them.
+    
+    The invalid rows are shown along with their errors.
+    
+    """
+    template_name = 'kdo/present_import.html'
+    form_class = kdo_forms.PresentImportForm
+    success_url = reverse_lazy('kdo-present-list')
+    
+    def form_valid(self, form):
+        data = form.cleaned_data
+        try:
+            rows = importer.parse(data['file'].read(), data['format'])
+        except importer.InvalidImport as e:
+            form.errors['file'] = form.error_class([unicode(e)])
+            return self.form_invalid(form)
+        
+        created, errors, skipped = importer.import_presents(self.request.user,
+                                                            rows)
+        if created:
+            msg = ungettext("%(count)d present has been imported.",
+                            "%(count)d presents have been imported.",
+                            len(created))
+            self.messages.success(msg % {'count': len(created)})
+        if skipped:
+            msg = ungettext("%(count)d present already existed.",
+                            "%(count)d presents already existed.",
+                            len(skipped))
+            self.messages.info(msg % {'count': len(skipped)})
+        if errors:
+            return self.render_to_response(self.get_context_data(
+                form=form, row_errors=errors))
+        return super(ImportView, self).form_valid(form)
+
+import_presents = ImportView.as_view()
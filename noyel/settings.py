@@ -17,6 +17,15 @@ DATABASES = {
     }
 }
 
+# The default local-memory cache is per-process: use a shared backend (like
+# memcached) in production so that cache invalidation reaches every process.
+# noyel.wsgi refuses to start with a local-memory cache when DEBUG is False.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -104,6 +113,12 @@ TEMPLATE_CONTEXT_PROCESSORS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # First, so that it runs once the transactions of the view are committed.
+    'noyel.kdo.middleware.CacheInvalidationMiddleware',
+    # Only active when KDO_INSTRUMENTATION is True (see below).
+    'noyel.kdo.middleware.InstrumentationMiddleware',
+    # Only active when KDO_PROFILING is True (see below).
+    'noyel.kdo.middleware.ProfilingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -135,6 +150,40 @@ LOGIN_REDIRECT_URL = 'kdo-landing'
 LOGIN_URL = 'kdo-login-required'
 LOGOUT_URL = 'logout'
 
+# Number of presents shown on each page of the present lists.
+KDO_PRESENTS_PER_PAGE = 50
+
+# Send the SQL and timing measures of each request in a Server-Timing header
+# and log them to the "noyel.kdo.instrumentation" logger.
+KDO_INSTRUMENTATION = False
+
+# Maximum number of queries allowed for each view (by URL name). Going over
+# the budget logs a warning, or raises an exception if KDO_QUERY_BUDGET_RAISE
+# is True.
+KDO_QUERY_BUDGETS = {
+    'kdo-present-list': 5,
+    'kdo-present-detail': 10,
+    'kdo-present-list-for-giftee': 5,
+    'kdo-invitation-list': 5,
+}
+KDO_QUERY_BUDGET_RAISE = False
+
+# Profile a sample of the requests with cProfile, as well as the requests
+# carrying a token from `manage.py profile_report --token` in their
+# X-Kdo-Profile header. The profiles are written in a directory per URL name
+# and aggregated by `manage.py profile_report`.
+KDO_PROFILING = False
+KDO_PROFILING_SAMPLE_RATE = 0.01
+KDO_PROFILING_DIR = path.join(PROJECT_DIR, 'profiles')
+KDO_PROFILING_MAX_FILES = 20 # for each URL name
+KDO_PROFILING_MAX_SIZE = 50 * 1024 * 1024 # in bytes, for all the profiles
+
+# Number of days after which `manage.py archive_presents` archives the
+# presents that were bought (and haven't changed since).
+KDO_ARCHIVE_AFTER_DAYS = 60
+
+# Emails are queued in the outbox (kdo.OutboundEmail) during the request and
+# sent by a separate worker: `manage.py send_outbox --loop`.
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
 INSTALLED_APPS = (
@@ -169,7 +218,13 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
-        }
+        },
+        # Set to INFO to print the measures of every request made while
+        # KDO_INSTRUMENTATION is True.
+        'console': {
+            'level': 'WARNING',
+            'class': 'logging.StreamHandler',
+        },
     },
     'loggers': {
         'django.request': {
@@ -177,6 +232,11 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'noyel.kdo.instrumentation': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     }
 }
 try:
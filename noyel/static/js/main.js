@@ -1,13 +1,76 @@
 $(function (){
+    // The user's giftees and friends, fetched once and filtered locally.
+    // The copy kept in localStorage is only refetched when the user's data
+    // version changes on the server.
+    var dictionary = null;
+    var storage = window.localStorage;
+
+    function load_dictionary() {
+        var stored = null;
+        try {
+            stored = JSON.parse(storage.getItem('kdo-dictionary'));
+        } catch (e) {}
+        var params = stored ? {'since': stored.version} : {};
+        return $.get('/api/dictionary/', params, function (data) {
+            if (data.unchanged) {
+                data = stored;
+            } else {
+                try {
+                    storage.setItem('kdo-dictionary', JSON.stringify(data));
+                } catch (e) {}
+            }
+            dictionary = data;
+            dictionary.keys = {};
+            $.each(data.giftees, function (i, giftee) {
+                dictionary.keys[giftee[0]] = giftee[1];
+            });
+        });
+    }
+
+    // Same as noyel.kdo.utils.normalize_giftee (where the browser can).
+    function normalize(name) {
+        if (name.normalize) {
+            name = name.normalize('NFKD').replace(/[\u0300-\u036f]/g, '');
+        }
+        return $.trim(name.replace(/\s+/g, ' ')).toLowerCase();
+    }
+
+    if ($('input[name=giftee], form.invite input[name=user]').length) {
+        load_dictionary();
+    }
+
     $('input[name=giftee]').attr('autocomplete', 'off').typeahead({
         'source': function (query, process) {
-            return $.get('/api/search/giftee/', {'q': query}, function (data) {
+            if (dictionary) {
+                this.query_key = normalize(query);
+                return $.map(dictionary.giftees, function (giftee) {
+                    return giftee[0];
+                });
+            }
+            // The dictionary isn't loaded yet: ask the server.
+            this.query_key = null;
+            var params = {'q': query, 'limit': this.options.items};
+            return $.get('/api/search/giftee/', params, function (data) {
                 return process(data)
             });
+        },
+        // Match the normalized names' prefix, like the server does.
+        'matcher': function (item) {
+            if (this.query_key === null) {
+                return true;
+            }
+            return dictionary.keys[item].indexOf(this.query_key) === 0;
+        },
+        // Keep the most frequent giftees first.
+        'sorter': function (items) {
+            return items;
         }
     });
     $('form.invite input[name=user]').attr('autocomplete', 'off').typeahead({
         'source': function (query, process) {
+            if (dictionary) {
+                return dictionary.friends;
+            }
             return $.get('/api/search/friend/', {'q': query}, function (data) {
                 return process(data)
             });
@@ -27,6 +27,15 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "noyel.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Refuse to serve with a cache that isn't shared by the processes.
+from noyel.kdo.cache import check_cache_backend
+check_cache_backend()
+
+# Load the email templates once for every language before serving requests.
+from noyel.kdo.emails import CachedEmailTemplate
+import noyel.account.emails
+CachedEmailTemplate.warm_cache()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)